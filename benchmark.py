@@ -0,0 +1,290 @@
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+import ceritas_data_layer
+
+# benchmark suite for ceritas_data_layer. builds a synthetic copy of the tables the layer reads in its own schema
+# of a local postgres database, at one or more scales, and times every public method against it.
+# results are printed as one json object per line (scale, method), so runs of different versions can be diffed:
+#
+#   python benchmark.py --database bench --user postgres --password "" --host localhost --scales 1000,100000 --label v2
+#
+# scale is the number of nvd_cves. the other tables are sized from it, see generate()
+
+SCHEMA = "ceritas_bench"
+
+TABLES = """
+CREATE TABLE nvd_cves (id integer PRIMARY KEY, cve text NOT NULL, severity numeric(3, 1), date_modified timestamp);
+CREATE TABLE core_rating_history (id serial PRIMARY KEY, core_product_id integer, value integer, created_at timestamp DEFAULT now());
+CREATE TABLE core_products (id integer PRIMARY KEY, uuid uuid NOT NULL, name text, current_rating_history_id integer);
+CREATE TABLE nvd_vendors (id integer PRIMARY KEY, cpe_vendor text NOT NULL);
+CREATE TABLE nvd_products (id integer PRIMARY KEY, nvd_vendor_id integer, core_product_id integer, cpe_short_product text);
+CREATE TABLE nvd_cpe_matches (id integer PRIMARY KEY, nvd_product_id integer);
+CREATE TABLE nvd_cpe_match_configuration (id integer PRIMARY KEY, nvd_cpe_match_id integer, nvd_configuration_id integer);
+CREATE TABLE nvd_configuration_cve (id integer PRIMARY KEY, nvd_configuration_id integer, nvd_cve_id integer);
+CREATE TABLE groups (id integer PRIMARY KEY, name text, is_default boolean);
+CREATE TABLE product_instances (id integer PRIMARY KEY, product_id integer);
+CREATE TABLE product_instance_group (id integer PRIMARY KEY, group_id integer, product_instance_id integer);
+"""
+
+INDEXES = """
+CREATE INDEX ON nvd_cves (cve);
+CREATE INDEX ON nvd_cves (date_modified);
+CREATE INDEX ON core_products (uuid);
+CREATE INDEX ON nvd_vendors (cpe_vendor);
+CREATE INDEX ON nvd_products (core_product_id);
+CREATE INDEX ON nvd_products (nvd_vendor_id);
+CREATE INDEX ON nvd_cpe_matches (nvd_product_id);
+CREATE INDEX ON nvd_cpe_match_configuration (nvd_cpe_match_id);
+CREATE INDEX ON nvd_configuration_cve (nvd_configuration_id);
+CREATE INDEX ON nvd_configuration_cve (nvd_cve_id);
+CREATE INDEX ON nvd_cpe_match_configuration (nvd_configuration_id);
+CREATE INDEX ON groups (name);
+CREATE INDEX ON product_instance_group (group_id);
+"""
+
+# rows sent per COPY while loading
+COPY_CHUNK = 50000
+
+# (re)creates the benchmark schema and fills it with a deterministic dataset of n_cves CVEs.
+# per 10 CVEs there is one core product, 80% of core products link to an nvd product, and a tenth of those to one or two more.
+# nvd products have 1-3 cpe matches (none for 5% of them), 1-2 configurations per match and 0-6 CVEs per configuration.
+# so the dataset holds the cases where ratings are easy to get wrong: core products rated on the lowest of several nvd products,
+# and nvd products without CVEs. half the products have a rating, and every 50 products make one customer group
+def generate(connection, n_cves, seed=0):
+    r = random.Random(seed)
+    n_products = max(n_cves // 10, 10)
+    n_vendors = max(n_products // 20, 1)
+    n_groups = max(n_products // 50, 2)
+    now = datetime(2024, 1, 1)
+
+    with connection.cursor() as cursor:
+        cursor.execute("DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path TO {schema};".format(schema=SCHEMA))
+        cursor.execute(TABLES)
+
+        _copy(cursor, "nvd_cves", ((id, "CVE-{}-{}".format(2000 + id % 25, id), round(r.uniform(0, 10), 1), now - timedelta(minutes=r.randint(0, 525600)))
+                for id in range(1, n_cves + 1)))
+
+        ratings = []
+        products = []
+        for id in range(1, n_products + 1):
+            rating_id = None
+            if r.random() < 0.5:
+                rating_id = len(ratings) + 1
+                ratings.append((rating_id, id, r.choice((100, 150, 200, 250)), now))
+            products.append((id, uuid.UUID(int=r.getrandbits(128)), "product{}".format(id), rating_id))
+        _copy(cursor, "core_rating_history", ratings)
+        # write_product_ratings inserts after the copied ids
+        cursor.execute("SELECT setval(pg_get_serial_sequence('core_rating_history', 'id'), %s, false);", (len(ratings) + 1,))
+        _copy(cursor, "core_products", products)
+        del ratings, products
+
+        _copy(cursor, "nvd_vendors", ((id, "vendor{}".format(id)) for id in range(1, n_vendors + 1)))
+
+        nvd_products = []
+        for core_product_id in range(1, n_products + 1):
+            if r.random() < 0.8:
+                nvd_products.append(core_product_id)
+        # a tenth of them get more nvd products, numbered after every first link
+        for core_product_id in list(nvd_products):
+            if r.random() < 0.1:
+                nvd_products.extend([core_product_id] * r.randint(1, 2))
+        # a tenth more nvd products that no core product links to
+        nvd_products.extend([None] * (len(nvd_products) // 10))
+        _copy(cursor, "nvd_products", ((id, r.randint(1, n_vendors), core_product_id, "cpe_product{}".format(id))
+                for id, core_product_id in enumerate(nvd_products, 1)))
+
+        matches = []
+        match_configurations = []
+        configuration_cves = []
+        for nvd_product_id in range(1, len(nvd_products) + 1):
+            for i in range(0 if r.random() < 0.05 else r.randint(1, 3)):
+                matches.append((len(matches) + 1, nvd_product_id))
+                for j in range(r.randint(1, 2)):
+                    configuration_id = len(match_configurations) + 1
+                    match_configurations.append((configuration_id, len(matches), configuration_id))
+                    for k in range(r.randint(0, 6)):
+                        configuration_cves.append((len(configuration_cves) + 1, configuration_id, r.randint(1, n_cves)))
+        _copy(cursor, "nvd_cpe_matches", matches)
+        _copy(cursor, "nvd_cpe_match_configuration", match_configurations)
+        _copy(cursor, "nvd_configuration_cve", configuration_cves)
+        del matches, match_configurations, configuration_cves
+
+        groups = []
+        instances = []
+        instance_groups = []
+        for group_id in range(1, n_groups + 1):
+            groups.append((group_id, "customer{}".format(group_id % max(n_groups // 2, 1)), group_id % 4 != 0))
+            for i in range(r.randint(0, 100)):
+                instances.append((len(instances) + 1, r.randint(1, n_products)))
+                instance_groups.append((len(instance_groups) + 1, group_id, len(instances)))
+        _copy(cursor, "groups", groups)
+        _copy(cursor, "product_instances", instances)
+        _copy(cursor, "product_instance_group", instance_groups)
+
+        cursor.execute(INDEXES)
+        for table in ("nvd_cves", "core_rating_history", "core_products", "nvd_vendors", "nvd_products", "nvd_cpe_matches",
+                "nvd_cpe_match_configuration", "nvd_configuration_cve", "groups", "product_instances", "product_instance_group"):
+            cursor.execute("ANALYZE {};".format(table))
+    connection.commit()
+
+    return {'cves': n_cves, 'products': n_products, 'nvd_products': len(nvd_products), 'groups': n_groups}
+
+def _copy(cursor, table, rows):
+    buffer = io.StringIO()
+    count = 0
+    for row in rows:
+        buffer.write("\t".join("\\N" if value is None else str(value) for value in row))
+        buffer.write("\n")
+        count += 1
+        if count % COPY_CHUNK == 0:
+            buffer.seek(0)
+            cursor.copy_expert("COPY {} FROM STDIN;".format(table), buffer)
+            buffer = io.StringIO()
+    buffer.seek(0)
+    cursor.copy_expert("COPY {} FROM STDIN;".format(table), buffer)
+
+# (name, function(db)) for every public method, called with ids from sample (see pick_sample)
+def benchmarks(sample):
+    return [
+        ("get_all_from_table", lambda db: db.get_all_from_table("nvd_cves")),
+        ("get_all_from_table[columns]", lambda db: db.get_all_from_table("nvd_cves", ["id", "severity"], format="columns")),
+        ("iter_all_from_table", lambda db: sum(1 for row in db.iter_all_from_table("nvd_cves"))),
+        ("get_count_from_table", lambda db: db.get_count_from_table("nvd_cves")),
+        ("get_all_customer_products", lambda db: db.get_all_customer_products("*")),
+        ("get_one_customer_products", lambda db: db.get_one_customer_products(sample['customer'], "*")),
+        ("get_customers_products", lambda db: db.get_customers_products(sample['customers'], "*")),
+        ("get_product_info_by_id", lambda db: db.get_product_info_by_id(sample['products'])),
+        ("get_product_info_by_uuid", lambda db: db.get_product_info_by_uuid(sample['uuids'])),
+        ("get_vulnerable_products", lambda db: db.get_vulnerable_products("*")),
+        ("iter_vulnerable_products", lambda db: sum(len(batch) for batch in db.iter_vulnerable_products("*", batches=True))),
+        ("get_product_rating", lambda db: db.get_product_rating(sample['products'])),
+        ("get_nvd_product_from_core_product", lambda db: db.get_nvd_product_from_core_product(sample['products'][0])),
+        ("get_product_vulnerability_ids", lambda db: db.get_product_vulnerability_ids(sample['products'])),
+        ("get_product_vulnerability_ids[by_product]", lambda db: db.get_product_vulnerability_ids(sample['products'], by_product=True)),
+        ("get_nvd_product_vulnerability_ids", lambda db: db.get_nvd_product_vulnerability_ids(sample['nvd_products'])),
+        ("get_cve_info_by_id", lambda db: db.get_cve_info_by_id(sample['cves'])),
+        ("iter_cve_info_by_id", lambda db: sum(len(batch) for batch in db.iter_cve_info_by_id(sample['cves'], batches=True))),
+        ("get_cve_info_by_name", lambda db: db.get_cve_info_by_name(sample['cve_names'])),
+        ("get_all_severities_for_product", lambda db: db.get_all_severities_for_product(sample['products'][0])),
+        ("get_severities_for_products", lambda db: db.get_severities_for_products(sample['products'])),
+        ("get_severities_for_products[aggregates]", lambda db: db.get_severities_for_products(sample['products'], aggregates=True, format="columns")),
+        ("get_nvd_vendor_by_name", lambda db: db.get_nvd_vendor_by_name(sample['vendor'])),
+        ("get_all_nvd_products_by_vendor", lambda db: db.get_all_nvd_products_by_vendor(sample['vendor'])),
+        ("rate_core_product", lambda db: db.rate_core_product(sample['rated_products'])),
+        ("rate_core_product_bulk", lambda db: db.rate_core_product_bulk(sample['products'])),
+        ("rate_changed_core_products", lambda db: db.rate_changed_core_products(sample['watermark'])),
+        ("rate_nvd_product", lambda db: db.rate_nvd_product(sample['rated_nvd_products'])),
+        ("rate_nvd_product_bulk", lambda db: db.rate_nvd_product_bulk(sample['nvd_products'])),
+        ("rate_core_product_parallel", lambda db: db.rate_core_product_parallel(sample['rated_products'], workers=4, chunk_size=25)),
+        ("rate_core_product_parallel[bulk]", lambda db: db.rate_core_product_parallel(sample['products'], workers=4, chunk_size=250, bulk=True)),
+        ("write_product_ratings", lambda db: db.write_product_ratings(sample['ratings'])),
+        # id lists past ID_ARRAY_LIMIT (batched "= ANY" filters) and ID_BATCH_LIMIT (temporary id table), whatever the scale
+        ("get_product_info_by_id[batched]", lambda db: db.get_product_info_by_id(sample['batched_ids'], "id")),
+        ("get_product_info_by_id[temp_table]", lambda db: db.get_product_info_by_id(sample['temp_table_ids'], "id")),
+        ("get_product_vulnerability_ids[temp_table]", lambda db: db.get_product_vulnerability_ids(sample['batched_ids'])),
+        ("rate_core_product_bulk[temp_table]", lambda db: db.rate_core_product_bulk(sample['temp_table_ids'])),
+    ]
+
+# picks the ids the benchmarks run with: up to sample_size products and CVEs, a smaller set for the per-product rating loops,
+# and id lists long enough for the batched and temporary table filters of _id_filters
+def pick_sample(db, sample_size, seed=0):
+    r = random.Random(seed)
+    products = [row[0] for row in db.query("SELECT id FROM core_products ORDER BY id LIMIT %s;", (sample_size,))]
+    nvd_products = [row[0] for row in db.query("SELECT id FROM nvd_products WHERE core_product_id IS NOT NULL ORDER BY id LIMIT %s;", (sample_size,))]
+    cves = [row[0] for row in db.query("SELECT id FROM nvd_cves ORDER BY id LIMIT %s;", (sample_size,))]
+    r.shuffle(products)
+    return {'products': products,
+            'uuids': [str(row[0]) for row in db.query("SELECT uuid FROM core_products WHERE id = ANY(%s);", (products,))],
+            'nvd_products': nvd_products,
+            'cves': cves,
+            'cve_names': [row[0] for row in db.query("SELECT cve FROM nvd_cves WHERE id = ANY(%s);", (cves,))],
+            'customer': db.query("SELECT name FROM groups WHERE is_default = true ORDER BY id LIMIT 1;")[0][0],
+            'customers': [row[0] for row in db.query("SELECT DISTINCT name FROM groups WHERE is_default = true;")],
+            'vendor': db.query("SELECT cpe_vendor FROM nvd_vendors ORDER BY id LIMIT 1;")[0][0],
+            'watermark': db.query("SELECT MAX(date_modified) - interval '1 day' FROM nvd_cves;")[0][0],
+            'rated_products': products[:100],
+            'rated_nvd_products': nvd_products[:100],
+            'ratings': {id: r.choice((100, 150, 200, 250)) for id in products},
+            'batched_ids': list(range(1, ceritas_data_layer.ID_ARRAY_LIMIT * 2 + 1)),
+            'temp_table_ids': list(range(1, ceritas_data_layer.ID_BATCH_LIMIT + 2))}
+
+# runs call repeat times for latency, then once more under tracemalloc for peak python memory.
+# query count and rows come from the layer's own instrumentation
+def measure(db, call, repeat):
+    instrumentation = db.enable_instrumentation()
+    latencies = []
+    for i in range(repeat):
+        instrumentation.reset()
+        start = time.perf_counter()
+        call(db)
+        latencies.append((time.perf_counter() - start) * 1000)
+    statements = instrumentation.report()['statements'].values()
+    db.disable_instrumentation()
+
+    tracemalloc.start()
+    call(db)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.commit()
+
+    return {'latency_ms': {'min': min(latencies), 'median': statistics.median(latencies), 'max': max(latencies)},
+            'queries': sum(stats['calls'] for stats in statements),
+            'rows': sum(stats['rows'] for stats in statements),
+            'bytes_sent': sum(stats['bytes_sent'] for stats in statements),
+            'peak_memory_bytes': peak_memory}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark ceritas_data_layer against a synthetic dataset")
+    parser.add_argument("--database", required=True)
+    parser.add_argument("--user", required=True)
+    parser.add_argument("--password", default="")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--scales", default="1000,10000,100000", help="comma separated numbers of CVEs to generate")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--sample-size", type=int, default=1000, help="number of ids passed to the list methods")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--methods", help="comma separated benchmark names to run, default all")
+    parser.add_argument("--label", default="", help="free text copied into every result, e.g. a version or commit")
+    parser.add_argument("--output", help="file to write results to, default stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the benchmark schema after the run")
+    args = parser.parse_args(argv)
+
+    # every connection the layer opens (streams, rating worker processes) has to read the benchmark schema, not just this one
+    os.environ["PGOPTIONS"] = (os.environ.get("PGOPTIONS", "") + " -c search_path={}".format(SCHEMA)).strip()
+    output = open(args.output, "w") if args.output else sys.stdout
+    selected = args.methods.split(",") if args.methods else None
+    db = ceritas_data_layer.Ceritas_Database(args.database, args.user, args.password, args.host)
+    try:
+        for scale in [int(value) for value in args.scales.split(",")]:
+            start = time.perf_counter()
+            sizes = generate(db.connection, scale, args.seed)
+            load_seconds = time.perf_counter() - start
+
+            sample = pick_sample(db, args.sample_size, args.seed)
+            for name, call in benchmarks(sample):
+                if selected is not None and name not in selected:
+                    continue
+                result = {'label': args.label, 'scale': scale, 'sizes': sizes, 'load_seconds': load_seconds, 'method': name}
+                result.update(measure(db, call, args.repeat))
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        if not args.keep:
+            db.connection.rollback()
+            db.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(SCHEMA))
+        db.close()
+        if args.output:
+            output.close()
+
+if __name__ == "__main__":
+    main()
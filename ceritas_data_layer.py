@@ -1,6 +1,22 @@
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 import configparser
+import threading
+import itertools
+import os
+import traceback
+import io
+import re
+import time
+import weakref
+from decimal import Decimal
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+from contextlib import contextmanager
+from functools import wraps
 
 config = configparser.ConfigParser(allow_no_value=True)
 config.read('Reporting/rating_config.ini')
@@ -16,14 +32,562 @@ ATTENTION_CUTOFF = float(config['Rating Cutoffs']['attention'])
 CAUTION_CUTOFF = float(config['Rating Cutoffs']['caution'])
 ALERT_CUTOFF = float(config['Rating Cutoffs']['alert'])
 
+# seconds a pooled call waits for a connection to be returned when maxconn connections are in use
+DEFAULT_POOL_TIMEOUT = 30.0
+# pooled connections idle for at least this many seconds are checked with a "SELECT 1" before they are handed out
+DEFAULT_POOL_PING_SECONDS = 10.0
+
+# rows fetched per round trip by the server-side cursors behind the iter_* methods
+DEFAULT_ITERSIZE = 2000
+
+# rows written per statement, and per commit, by write_product_ratings
+DEFAULT_WRITE_BATCH = 5000
+
+# how far before its watermark rate_changed_core_products looks again, for CVEs committed late by a sync still running at the last run
+WATERMARK_LAG = timedelta(minutes=30)
+
+# products per shard handed to each worker process by rate_core_product_parallel
+DEFAULT_RATING_CHUNK = 1000
+
+# id lists up to this size are sent as one array parameter: "column = ANY(%s)"
+ID_ARRAY_LIMIT = 10000
+# larger lists are sent in batches of ID_ARRAY_LIMIT ids, for statements whose results can be concatenated, up to this size.
+# beyond it, or for statements that can't be split, the ids are loaded into a temporary table with COPY and joined
+ID_BATCH_LIMIT = 100000
+
+# a statement run this many times on one connection gets prepared server side, and runs through EXECUTE from then on
+PREPARE_THRESHOLD = 2
+
+# upper bounds, in milliseconds, of the latency histogram buckets kept by Instrumentation. the last bucket has no upper bound
+LATENCY_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+# statements shared by Ceritas_Database and AsyncCeritasDatabase (ceritas_data_layer_async.py). "{...}" fields are filled in
+# with str.format, "%s" are query parameters, which psycopg2 and psycopg 3 both accept
+
+# core products of customers' default groups. column: core_products columns. where: extra condition on groups g, starting with " AND"
+CUSTOMER_PRODUCTS_SQL = (
+    "SELECT {column} FROM core_products WHERE id IN ("
+    "SELECT pi.product_id FROM groups g "
+    "JOIN product_instance_group pig ON pig.group_id = g.id "
+    "JOIN product_instances pi ON pi.id = pig.product_instance_id "
+    "WHERE g.is_default = true{where});")
+
+# (customer name, product columns) rows of the customers whose group names match ids. column: columns of core_products p
+CUSTOMERS_PRODUCTS_SQL = (
+    "SELECT c.name, {column} FROM ("
+    "SELECT DISTINCT g.name, pi.product_id FROM groups g "
+    "JOIN product_instance_group pig ON pig.group_id = g.id "
+    "JOIN product_instances pi ON pi.id = pig.product_instance_id "
+    "WHERE g.is_default = true AND {ids}) c "
+    "JOIN core_products p ON p.id = c.product_id;")
+
+# (core product id, rating columns) rows. columns: core_rating_history h columns. ids: filter on core_products p
+PRODUCT_RATING_SQL = (
+    "SELECT p.id, {columns} FROM core_products p "
+    "JOIN core_rating_history h ON h.id = p.current_rating_history_id "
+    "WHERE {ids};")
+
+# one (found, nvd_cve_ids) row for the nvd_products matching where. found is False if none matched
+VULNERABILITY_IDS_SQL = (
+    "WITH nvd AS (SELECT id FROM nvd_products WHERE {where}) "
+    "SELECT EXISTS (SELECT 1 FROM nvd), ARRAY("
+    "SELECT cc.nvd_cve_id FROM nvd_configuration_cve cc WHERE cc.nvd_configuration_id IN ("
+    "SELECT mc.nvd_configuration_id FROM nvd_cpe_match_configuration mc "
+    "JOIN nvd_cpe_matches m ON m.id = mc.nvd_cpe_match_id "
+    "WHERE m.nvd_product_id IN (SELECT id FROM nvd)));")
+
+# (key, nvd_cve_id) rows for the nvd_products matching where, grouped by their "key" column. products without CVEs get a NULL nvd_cve_id
+VULNERABILITIES_BY_PRODUCT_SQL = (
+    "WITH nvd AS (SELECT id, {key} AS key FROM nvd_products WHERE {where}), "
+    "configurations AS ("
+    "SELECT DISTINCT nvd.key, mc.nvd_configuration_id FROM nvd "
+    "LEFT JOIN nvd_cpe_matches m ON m.nvd_product_id = nvd.id "
+    "LEFT JOIN nvd_cpe_match_configuration mc ON mc.nvd_cpe_match_id = m.id) "
+    "SELECT c.key, cc.nvd_cve_id FROM configurations c "
+    "LEFT JOIN nvd_configuration_cve cc ON cc.nvd_configuration_id = c.nvd_configuration_id;")
+
+# (key, weighted severity sum) rows for the nvd_products whose "key" column matches ids, taking the lowest nvd_product id per key.
+# each distinct CVE is counted once. parameters: the id filter's, then WEIGHT_PARAMS
+WEIGHTED_SEVERITY_SUMS_SQL = (
+    "WITH nvd AS ("
+    "SELECT DISTINCT ON ({key}) {key} AS key, id FROM nvd_products WHERE {ids} ORDER BY {key}, id), "
+    "cves AS ("
+    "SELECT DISTINCT nvd.key, cc.nvd_cve_id FROM nvd "
+    "JOIN nvd_cpe_matches m ON m.nvd_product_id = nvd.id "
+    "JOIN nvd_cpe_match_configuration mc ON mc.nvd_cpe_match_id = m.id "
+    "JOIN nvd_configuration_cve cc ON cc.nvd_configuration_id = mc.nvd_configuration_id), "
+    "weighted AS ("
+    "SELECT cves.key, CASE "
+    "WHEN c.severity::float8 >= 9.0 THEN c.severity::float8 * %s "
+    "WHEN c.severity::float8 >= 7.0 THEN c.severity::float8 * %s "
+    "ELSE c.severity::float8 * %s END AS severity "
+    "FROM cves JOIN nvd_cves c ON c.id = cves.nvd_cve_id) "
+    "SELECT nvd.key, COALESCE(SUM(weighted.severity), 0.0) FROM nvd "
+    "LEFT JOIN weighted ON weighted.key = nvd.key GROUP BY nvd.key;")
+WEIGHT_PARAMS = (CRITICAL_WEIGHT, HIGH_WEIGHT, LOW_WEIGHT)
+
+_stream_names = itertools.count()
+_temp_table_names = itertools.count()
+
+# decorator for public methods. in pool mode, borrows a connection for the length of the call,
+# so every query the method makes runs on the same connection. nested calls reuse the borrowed connection.
+# when instrumentation is on, the call is timed and its statements are counted against it
+def _borrows_connection(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._instrumentation is None:
+            with self.borrow():
+                return method(self, *args, **kwargs)
+        with self._instrumentation.method(method.__name__), self.borrow():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+# read-through cache of nvd_cves rows, keyed by id with a secondary index on the cve name.
+# least recently used rows are evicted past maxsize, and rows older than ttl seconds are fetched again.
+# one cache can be shared by several Ceritas_Database instances, it is thread safe
+class CveCache:
+    def __init__(self, maxsize=10000, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._names = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    # returns the cached row for an nvd_cve id, or None on a miss
+    def get(self, nvd_cve_id):
+        with self._lock:
+            entry = self._rows.get(nvd_cve_id)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(nvd_cve_id)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(nvd_cve_id)
+            self.hits += 1
+            return entry[1]
+
+    # returns the cached row for a cve string, or None on a miss
+    def get_by_name(self, cve):
+        with self._lock:
+            nvd_cve_id = self._names.get(cve)
+        if nvd_cve_id is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        return self.get(nvd_cve_id)
+
+    # row: full nvd_cves row, as a dict
+    def put(self, row):
+        with self._lock:
+            self._remove(row['id'])
+            self._rows[row['id']] = (time.monotonic() + self.ttl, row)
+            self._names[row['cve']] = row['id']
+            while len(self._rows) > self.maxsize:
+                self._remove(next(iter(self._rows)))
+
+    # drops the given ids and cve names from the cache. with no arguments the whole cache is cleared
+    def invalidate(self, nvd_cve_id=None, cve=None):
+        with self._lock:
+            if nvd_cve_id is None and cve is None:
+                self._rows.clear()
+                self._names.clear()
+                return
+            if nvd_cve_id is not None:
+                if type(nvd_cve_id) is not list: nvd_cve_id = [ nvd_cve_id ]
+                for id in nvd_cve_id:
+                    self._remove(id)
+            if cve is not None:
+                if type(cve) is not list: cve = [ cve ]
+                for name in cve:
+                    id = self._names.get(name)
+                    if id is not None:
+                        self._remove(id)
+
+    def _remove(self, nvd_cve_id):
+        entry = self._rows.pop(nvd_cve_id, None)
+        if entry is not None and self._names.get(entry[1]['cve']) == nvd_cve_id:
+            del self._names[entry[1]['cve']]
+
+# per-connection cache of server side prepared statements, keyed by the final sql text (so by template and column list).
+# statements are prepared once they have run "threshold" times on a connection, which keeps one-off statements out.
+# each connection keeps at most maxsize statements, least recently used ones are deallocated at the start of the next transaction.
+# a connection that reconnected (new backend pid) starts over with an empty cache, and statements are prepared again.
+# a session can also lose its statements between transactions (DISCARD ALL, a server side reset), so the first EXECUTE of a statement
+# in a transaction is retried after preparing it again: at the start of the transaction after a rollback, further in under a savepoint
+# that is sent in the same round trip and released afterwards. later EXECUTEs of it in the same transaction need neither
+class PreparedStatementCache:
+    def __init__(self, maxsize=256, threshold=PREPARE_THRESHOLD):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._names = itertools.count()
+
+    # runs sql on cursor, through a prepared statement when there is one.
+    # run: optional function(cursor, sql) used for the PREPARE, DEALLOCATE and savepoint statements, so they can be counted by instrumentation
+    def execute(self, cursor, sql, params=None, run=None):
+        if run is None:
+            run = lambda cursor, sql: cursor.execute(sql)
+        connection = cursor.connection
+        state = self._state(connection)
+        # nothing ran in the connection's transaction yet, so a failed statement can be rolled back without losing anything
+        idle = connection.autocommit or connection.info.transaction_status == TRANSACTION_STATUS_IDLE
+        if idle:
+            state['transaction'] += 1
+            self._deallocate(cursor, state, run)
+
+        # entries: [uses, statement name, last transaction the statement was prepared or executed in]
+        statements = state['statements']
+        entry = statements.get(sql)
+        if entry is None:
+            entry = statements[sql] = [0, None, None]
+        else:
+            statements.move_to_end(sql)
+        entry[0] += 1
+        while len(statements) > self.maxsize:
+            evicted_sql, (uses, evicted_name, evicted_transaction) = statements.popitem(last=False)
+            if evicted_name is not None:
+                state['evicted'].append(evicted_name)
+
+        if entry[1] is None and entry[0] >= self.threshold:
+            self._prepare(cursor, sql, entry, state, run)
+        if entry[1] is None:
+            cursor.execute(sql, params or ())
+            return
+
+        params = params or ()
+        if idle:
+            try:
+                cursor.execute(self._execute_sql(entry, params), params)
+            except psycopg2.errors.InvalidSqlStatementName:
+                if not connection.autocommit:
+                    connection.rollback()
+                self._reprepare(cursor, sql, entry, state, run)
+                cursor.execute(self._execute_sql(entry, params), params)
+        elif entry[2] == state['transaction']:
+            try:
+                cursor.execute(self._execute_sql(entry, params), params)
+            except psycopg2.errors.InvalidSqlStatementName:
+                # deallocated by someone else inside this transaction, which is aborted now. start over on the next call
+                self.clear(connection)
+                raise
+        else:
+            try:
+                cursor.execute("SAVEPOINT ceritas_prepared; " + self._execute_sql(entry, params), params)
+            except psycopg2.errors.InvalidSqlStatementName:
+                with connection.cursor() as savepoint_cursor:
+                    run(savepoint_cursor, "ROLLBACK TO SAVEPOINT ceritas_prepared;")
+                self._reprepare(cursor, sql, entry, state, run)
+                cursor.execute(self._execute_sql(entry, params), params)
+            # on a cursor of its own, so the results of the EXECUTE stay readable
+            with connection.cursor() as savepoint_cursor:
+                run(savepoint_cursor, "RELEASE SAVEPOINT ceritas_prepared;")
+        entry[2] = state['transaction']
+
+    def _execute_sql(self, entry, params):
+        arguments = " ({})".format(", ".join(["%s"] * len(params))) if len(params) > 0 else ""
+        return "EXECUTE {name}{arguments};".format(name=entry[1], arguments=arguments)
+
+    def _prepare(self, cursor, sql, entry, state, run):
+        name = "ceritas_statement_{}".format(next(self._names))
+        run(cursor, "PREPARE {name} AS {sql}".format(name=name, sql=_numbered_placeholders(sql)))
+        entry[1] = name
+        entry[2] = state['transaction']
+
+    # the session lost its prepared statements, all of them: sql is prepared again now, the others on their next use
+    def _reprepare(self, cursor, sql, entry, state, run):
+        for other in state['statements'].values():
+            other[1] = None
+        state['evicted'] = []
+        self._prepare(cursor, sql, entry, state, run)
+
+    # deallocates the evicted statements. only called at the start of a transaction, where one the session already lost can be rolled back
+    def _deallocate(self, cursor, state, run):
+        while len(state['evicted']) > 0:
+            try:
+                run(cursor, "DEALLOCATE {};".format(state['evicted'][-1]))
+            except psycopg2.errors.InvalidSqlStatementName:
+                if not cursor.connection.autocommit:
+                    cursor.connection.rollback()
+                for entry in state['statements'].values():
+                    entry[1] = None
+                state['evicted'] = []
+                return
+            state['evicted'].pop()
+
+    # forgets the statements of one connection, or of every connection
+    def clear(self, connection=None):
+        with self._lock:
+            if connection is None:
+                self._connections.clear()
+            else:
+                self._connections.pop(connection, None)
+
+    # statements of a connection, with the names evicted but not deallocated yet and a counter of the transactions seen on it
+    def _state(self, connection):
+        with self._lock:
+            state = self._connections.get(connection)
+            if state is None or state['pid'] != connection.info.backend_pid:
+                state = self._connections[connection] = {'pid': connection.info.backend_pid,
+                        'statements': OrderedDict(),
+                        'evicted': [],
+                        'transaction': 0}
+            return state
+
+# counters for one public method or one sql template
+class QueryStats:
+    def __init__(self):
+        self.calls = 0
+        self.round_trips = 0
+        self.rows = 0
+        self.bytes_sent = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add_latency(self, seconds):
+        self.seconds += seconds
+        milliseconds = seconds * 1000
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if milliseconds <= bound:
+                self.histogram[i] += 1
+                return
+        self.histogram[-1] += 1
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'round_trips': self.round_trips,
+                'rows': self.rows,
+                'bytes_sent': self.bytes_sent,
+                'seconds': self.seconds,
+                'histogram': dict(zip([str(bound) for bound in LATENCY_BUCKETS_MS] + ['inf'], self.histogram))}
+
+# records latency, round trips and rows per public method and per sql template.
+# method counters are inclusive: a statement counts against every method on the call stack, so rate_core_product
+# shows the round trips of the get_* calls it makes. bytes_sent is the size of the final query text (psycopg2 does not
+# expose bytes received). statements slower than slow_query_seconds are run again under EXPLAIN (ANALYZE, BUFFERS)
+# and kept in slow_queries. hooks are called with a dict for every method call, statement and slow query
+class Instrumentation:
+    def __init__(self, slow_query_seconds=None, explain=True, max_slow_queries=100):
+        self.slow_query_seconds = slow_query_seconds
+        self.explain = explain
+        self.methods = {}
+        self.statements = {}
+        self.slow_queries = deque(maxlen=max_slow_queries)
+        self.hooks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    # hook: callable taking one event dict, with "kind" set to "method", "statement" or "slow_query"
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def reset(self):
+        with self._lock:
+            self.methods = {}
+            self.statements = {}
+            self.slow_queries.clear()
+
+    # machine readable snapshot of every counter
+    def report(self):
+        with self._lock:
+            return {'methods': {name: stats.as_dict() for name, stats in self.methods.items()},
+                    'statements': {sql: stats.as_dict() for sql, stats in self.statements.items()},
+                    'slow_queries': list(self.slow_queries)}
+
+    @contextmanager
+    def method(self, name):
+        with self._lock:
+            stats = self.methods.setdefault(name, QueryStats())
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(stats)
+        start = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                stats.calls += 1
+                stats.add_latency(seconds)
+            self._emit({'kind': 'method', 'name': name, 'seconds': seconds})
+
+    # cursor: the cursor that just ran sql. params: the statement's parameters, used to explain slow statements
+    # explain: False for statements that must not run twice (writes, ddl), they are logged as slow without a plan.
+    # the others are explained inside a savepoint that is rolled back, so EXPLAIN ANALYZE never leaves changes behind
+    def statement(self, cursor, sql, params, seconds, explain=True):
+        template = _statement_template(sql)
+        rows = max(cursor.rowcount, 0)
+        bytes_sent = len(cursor.query or b"")
+        with self._lock:
+            stats = self.statements.setdefault(template, QueryStats())
+            stats.calls += 1
+            stats.add_latency(seconds)
+            for record in [stats] + getattr(self._local, 'stack', []):
+                record.round_trips += 1
+                record.rows += rows
+                record.bytes_sent += bytes_sent
+        self._emit({'kind': 'statement', 'sql': template, 'seconds': seconds, 'rows': rows, 'bytes_sent': bytes_sent})
+
+        if self.slow_query_seconds is not None and seconds >= self.slow_query_seconds:
+            slow_query = {'kind': 'slow_query', 'sql': sql, 'params': params, 'seconds': seconds, 'plan': None}
+            if self.explain and explain and sql.lstrip().upper().startswith(("SELECT", "WITH")):
+                slow_query['plan'] = self._explain(cursor.connection, sql, params)
+            with self._lock:
+                self.slow_queries.append(slow_query)
+            self._emit(slow_query)
+
+    def _explain(self, connection, sql, params):
+        autocommit = connection.autocommit
+        with connection.cursor() as explain_cursor:
+            explain_cursor.execute("BEGIN;" if autocommit else "SAVEPOINT ceritas_explain;")
+            try:
+                explain_cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + sql, params or ())
+                return "\n".join(row[0] for row in explain_cursor.fetchall())
+            except psycopg2.Error as error:
+                return "EXPLAIN failed: {}".format(error)
+            finally:
+                explain_cursor.execute("ROLLBACK;" if autocommit else "ROLLBACK TO SAVEPOINT ceritas_explain;")
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
 class Ceritas_Database:
     def __init__(self, database, user, password, host):
-        self._conn = psycopg2.connect(database=database,
+        self._init_state(None, psycopg2.connect(database=database,
+                user=user,
+                password=password,
+                host=host),
+            {'database': database, 'user': user, 'password': password, 'host': host})
+
+    # pooled mode: one instance can be shared between threads. each public method call borrows a
+    # connection from the pool and returns it when done, so only minconn..maxconn connections are ever opened.
+    # to run several raw execute/fetch calls on one connection, wrap them in "with db.borrow():"
+    # timeout: seconds a call waits for a free connection once maxconn are in use, before raising PoolError.
+    # open iter_* generators hold a connection each until they are exhausted or closed
+    # ping_after: connections idle in the pool for this many seconds are checked before use, and replaced if the server dropped them.
+    # 0 checks every connection handed out, at the cost of one round trip per call
+    @classmethod
+    def from_pool(cls, minconn, maxconn, database, user, password, host, timeout=DEFAULT_POOL_TIMEOUT, ping_after=DEFAULT_POOL_PING_SECONDS):
+        db = cls.__new__(cls)
+        db._init_state(ThreadedConnectionPool(minconn, maxconn,
+                database=database,
                 user=user,
                 password=password,
-                host=host)
-        self._cursor = self._conn.cursor()
-        self._dict_cursor = self._conn.cursor(cursor_factory=RealDictCursor)
+                host=host),
+            None,
+            {'database': database, 'user': user, 'password': password, 'host': host})
+        db._pool_timeout = timeout
+        db._ping_after = ping_after
+        return db
+
+    # instance state shared by both constructors. pool: connection pool in pool mode, conn: the single connection otherwise
+    def _init_state(self, pool, conn, connect_args):
+        self._pool = pool
+        self._cve_cache = None
+        self._prepared = None
+        self._instrumentation = None
+        self._local = threading.local()
+        self._connect_args = connect_args
+        # one slot per pooled connection, so calls past maxconn wait instead of failing
+        self._pool_slots = threading.BoundedSemaphore(pool.maxconn) if pool is not None else None
+        self._pool_timeout = DEFAULT_POOL_TIMEOUT
+        self._ping_after = DEFAULT_POOL_PING_SECONDS
+        self._returned_at = weakref.WeakKeyDictionary()
+        self._returned_lock = threading.Lock()
+        self._conn = conn
+        self._cursor = conn.cursor() if conn is not None else None
+        self._dict_cursor = conn.cursor(cursor_factory=RealDictCursor) if conn is not None else None
+
+    @property
+    def pooled(self):
+        return self._pool is not None
+
+    # borrows a connection from the pool for the current thread. does nothing outside of pool mode.
+    # on success the connection is committed, on error rolled back. broken connections are discarded from the pool
+    @contextmanager
+    def borrow(self):
+        if self._pool is None or getattr(self._local, 'conn', None) is not None:
+            yield self
+            return
+
+        conn = self._getconn()
+        self._local.conn = conn
+        self._local.cursor = conn.cursor()
+        self._local.dict_cursor = conn.cursor(cursor_factory=RealDictCursor)
+        broken = False
+        try:
+            yield self
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self._local.cursor.close()
+            self._local.dict_cursor.close()
+            self._local.conn = None
+            self._local.cursor = None
+            self._local.dict_cursor = None
+            self._putconn(conn, close=broken or bool(conn.closed))
+
+    # takes a connection from the pool, waiting up to the pool timeout while maxconn connections are in use.
+    # connections that are closed, or that fail the ping (see from_pool), are discarded and another one is taken
+    def _getconn(self):
+        if not self._pool_slots.acquire(timeout=self._pool_timeout):
+            raise PoolError("no pooled connection was free within {} seconds".format(self._pool_timeout))
+        try:
+            while True:
+                conn = self._pool.getconn()
+                if self._alive(conn):
+                    return conn
+                self._pool.putconn(conn, close=True)
+        except Exception:
+            self._pool_slots.release()
+            raise
+
+    def _putconn(self, conn, close=False):
+        if not close:
+            with self._returned_lock:
+                self._returned_at[conn] = time.monotonic()
+        self._pool.putconn(conn, close=close)
+        self._pool_slots.release()
+
+    # a closed flag only shows connections closed on this side. one the server dropped is only found by using it,
+    # so connections that sat in the pool for ping_after seconds run a "SELECT 1" first. new connections are not checked
+    def _alive(self, conn):
+        if conn.closed:
+            return False
+        with self._returned_lock:
+            returned_at = self._returned_at.pop(conn, None)
+        if returned_at is None or time.monotonic() - returned_at < self._ping_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _borrowed(self, name):
+        value = getattr(self._local, name, None)
+        if value is None:
+            raise RuntimeError("no pooled connection borrowed by this thread. wrap the calls in Ceritas_Database.borrow()")
+        return value
 
     def __enter__(self):
         return self
@@ -33,26 +597,54 @@ class Ceritas_Database:
 
     @property
     def connection(self):
+        if self._pool is not None:
+            return self._borrowed('conn')
         return self._conn
 
     @property
     def cursor(self):
+        if self._pool is not None:
+            return self._borrowed('cursor')
         return self._cursor
 
     @property
     def dict_cursor(self):
+        if self._pool is not None:
+            return self._borrowed('dict_cursor')
         return self._dict_cursor
 
     def commit(self):
         self.connection.commit()
 
+    @property
+    def cve_cache(self):
+        return self._cve_cache
+
+    # turns on the read-through CVE cache used by get_cve_info_by_id and get_cve_info_by_name.
+    # pass an existing CveCache to share it between instances, or maxsize/ttl to make a new one
+    def enable_cve_cache(self, maxsize=10000, ttl=3600, cache=None):
+        self._cve_cache = cache or CveCache(maxsize, ttl)
+        return self._cve_cache
+
+    def disable_cve_cache(self):
+        self._cve_cache = None
+
+    # drops ids and/or cve names from the CVE cache, or everything if called with no arguments
+    def invalidate_cve_cache(self, nvd_cve_id=None, cve=None):
+        if self._cve_cache is not None:
+            self._cve_cache.invalidate(nvd_cve_id, cve)
+
+    # in pool mode, closes every pooled connection. borrowed connections are committed when they are returned
     def close(self, commit=True):
+        if self._pool is not None:
+            self._pool.closeall()
+            return
         if commit:
             self.commit()
         self.connection.close()
 
     def execute(self, sql, params=None):
-        self.cursor.execute(sql, params or ())
+        self._execute(self.cursor, sql, params, prepare=False, explain=False)
 
     def fetchall(self):
         return self.cursor.fetchall()
@@ -60,9 +652,61 @@ class Ceritas_Database:
     def fetchone(self):
         return self.cursor.fetchone()
 
+    @_borrows_connection
     def query(self, sql, params=None):
-        self.cursor.execute(sql, params or ())
+        self._execute(self.cursor, sql, params, prepare=False, explain=False)
         return self.fetchall()
+
+    # turns on server side prepared statements for the queries the get_* and rate_* methods run. see PreparedStatementCache.
+    # not for use behind a connection pooler in transaction mode, where sessions and their statements are shared
+    def enable_prepared_statements(self, maxsize=256, threshold=PREPARE_THRESHOLD):
+        self._prepared = PreparedStatementCache(maxsize, threshold)
+        return self._prepared
+
+    def disable_prepared_statements(self):
+        self._prepared = None
+
+    @property
+    def instrumentation(self):
+        return self._instrumentation
+
+    # turns on query instrumentation, see Instrumentation. returns the Instrumentation object holding the counters.
+    # slow_query_seconds: statements at least this slow are logged with their EXPLAIN (ANALYZE, BUFFERS) plan
+    def enable_instrumentation(self, slow_query_seconds=None, explain=True, instrumentation=None):
+        self._instrumentation = instrumentation or Instrumentation(slow_query_seconds, explain)
+        return self._instrumentation
+
+    def disable_instrumentation(self):
+        self._instrumentation = None
+
+    # runs a query, through the prepared statement cache when it is on and prepare is True, and records it when instrumentation is on.
+    # explain: pass False for anything that is not a read (writes, ddl, raw sql), so a slow run is never repeated under EXPLAIN ANALYZE
+    def _execute(self, cursor, sql, params=None, prepare=True, explain=True):
+        if self._instrumentation is not None:
+            start = time.perf_counter()
+        if prepare and self._prepared is not None and not _reads_temporary_table(sql):
+            self._prepared.execute(cursor, sql, params, lambda cursor, sql: self._execute(cursor, sql, prepare=False, explain=False))
+        else:
+            cursor.execute(sql, params or ())
+        if self._instrumentation is not None:
+            self._instrumentation.statement(cursor, sql, params, time.perf_counter() - start, explain)
+
+    # runs sql through execute_values, page_size rows per statement, and returns the rows of every page. recorded by instrumentation like _execute
+    def _execute_values(self, cursor, sql, rows, page_size):
+        if self._instrumentation is not None:
+            start = time.perf_counter()
+        result = execute_values(cursor, sql, rows, page_size=page_size, fetch=True)
+        if self._instrumentation is not None:
+            self._instrumentation.statement(cursor, sql, None, time.perf_counter() - start, explain=False)
+        return result
+
+    # runs a COPY ... FROM STDIN with the data in file, recorded by instrumentation like _execute
+    def _copy_expert(self, cursor, sql, file):
+        if self._instrumentation is not None:
+            start = time.perf_counter()
+        cursor.copy_expert(sql, file)
+        if self._instrumentation is not None:
+            self._instrumentation.statement(cursor, sql, None, time.perf_counter() - start, explain=False)
         
     def parse_condition(self, condition):
         words = condition.split()
@@ -89,7 +733,19 @@ class Ceritas_Database:
     # retrieves all rows from a table. 
     # table: string. name of table to pull from
     # column: optional, string or list of strings. column(s) to pull instead of all columns
-    def get_all_from_table(self, table, column=None, condition=None, nonnull=None):
+    @_borrows_connection
+    def get_all_from_table(self, table, column=None, condition=None, nonnull=None, format=None):
+        sql, val = self._table_sql(table, column, condition, nonnull)
+        return self._fetch(sql, val, format)
+
+    # streaming version of get_all_from_table, for tables too large to hold in memory.
+    # rows are read through a server-side cursor, itersize rows per round trip.
+    # yields one row at a time, or lists of up to itersize rows if batches is True
+    def iter_all_from_table(self, table, column=None, condition=None, nonnull=None, itersize=DEFAULT_ITERSIZE, batches=False):
+        sql, val = self._table_sql(table, column, condition, nonnull)
+        return self._stream(sql, val, itersize, batches)
+
+    def _table_sql(self, table, column=None, condition=None, nonnull=None):
         column_txt = self.list_to_sql(column)
         sql = "SELECT {columns} FROM {table}".format(columns=column_txt or '*', table=table)
         if condition is not None:
@@ -102,18 +758,112 @@ class Ceritas_Database:
         else:
             val = ()
 
-             if nonnull is not None:
+            if nonnull is not None:
                 sql = sql + " WHERE {} IS NOT NULL".format(nonnull)
-        self.dict_cursor.execute(sql, val)
-        result = self.dict_cursor.fetchall()
-        items = []
-        for item in result:
-            items.append(item)
-        return items
+        return sql, val
+
+    # runs sql on a named (server-side) cursor and yields dict rows as they arrive.
+    # each stream reads on a connection of its own (see _stream_connection), held until the generator is exhausted or closed,
+    # so commits made while iterating, such as write_product_ratings batches, and other streams don't invalidate its cursor
+    def _stream(self, sql, params, itersize, batches):
+        return self._stream_many(lambda connection: [(sql, params)], itersize, batches)
+
+    # same as _stream, for a sequence of (sql, params) statements run one after the other.
+    # statements: function taking the stream's connection and returning the statements, so id filters can make their temporary tables on it
+    def _stream_many(self, statements, itersize, batches):
+        with self._stream_connection() as connection:
+            for sql, params in statements(connection):
+                with connection.cursor(name="ceritas_stream_{}".format(next(_stream_names)), cursor_factory=RealDictCursor) as cursor:
+                    cursor.itersize = itersize
+                    self._execute(cursor, sql, params, prepare=False)
+                    if batches:
+                        while True:
+                            rows = cursor.fetchmany(itersize)
+                            if not rows:
+                                break
+                            yield rows
+                    else:
+                        for row in cursor:
+                            yield row
+
+    # a connection for one stream: taken from the pool in pool mode, a new one with this instance's credentials otherwise.
+    # streams only read, so the connection is rolled back when the stream ends
+    @contextmanager
+    def _stream_connection(self):
+        if self._pool is not None:
+            connection = self._getconn()
+        else:
+            connection = psycopg2.connect(**self._connect_args)
+        broken = False
+        try:
+            yield connection
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if not connection.closed and not broken:
+                connection.rollback()
+            if self._pool is not None:
+                self._putconn(connection, close=broken or bool(connection.closed))
+            else:
+                connection.close()
+
+    # runs a select and returns the rows in the requested format. see to_format
+    def _fetch(self, sql, params, format=None):
+        return self._fetch_many([(sql, params)], format)
+
+    # same as _fetch, for a sequence of (sql, params) statements whose rows are concatenated
+    def _fetch_many(self, statements, format=None):
+        rows = []
+        names = None
+        for sql, params in statements:
+            if format is None or format == "rows":
+                self._execute(self.dict_cursor, sql, params)
+                rows.extend(self.dict_cursor.fetchall())
+            else:
+                self._execute(self.cursor, sql, params)
+                names = [description[0] for description in self.cursor.description]
+                rows.extend(self.cursor.fetchall())
+        if format is None or format == "rows":
+            return rows
+        return to_format(names or [], rows, format)
+
+    # filters a statement on a list of ids, picking the strategy by list size. yields (sql, params) pairs to run:
+    # "sql" is the filter condition to put in the statement, "params" its parameters.
+    #   up to ID_ARRAY_LIMIT ids: one "column = ANY(%s)" array parameter
+    #   up to ID_BATCH_LIMIT ids, if split is True: one "= ANY" filter per ID_ARRAY_LIMIT ids. only for statements whose results can be concatenated
+    #   otherwise: ids are copied into a temporary table, joined with "column IN (SELECT id FROM ...)", and the table is dropped afterwards
+    # table, column: the column being filtered on. the temporary table copies its type. alias: optional table alias used in the statement
+    # connection: the connection the statements run on, if not the borrowed one. the temporary table is made on it
+    # ids are cleaned up first, see _filter_ids. an empty list yields a "false" condition, so the statement still runs and returns no rows
+    def _id_filters(self, table, column, ids, split=False, alias=None, connection=None):
+        target = column if alias is None else "{}.{}".format(alias, column)
+        connection = connection or self.connection
+        ids = _filter_ids(ids)
+        if len(ids) == 0:
+            yield "false", ()
+        elif len(ids) <= ID_ARRAY_LIMIT:
+            yield "{} = ANY(%s)".format(target), (_array_literal(ids),)
+        elif split and len(ids) <= ID_BATCH_LIMIT:
+            for start in range(0, len(ids), ID_ARRAY_LIMIT):
+                yield "{} = ANY(%s)".format(target), (_array_literal(ids[start:start + ID_ARRAY_LIMIT]),)
+        else:
+            name = "ceritas_ids_{}".format(next(_temp_table_names))
+            with connection.cursor() as cursor:
+                self._execute(cursor, "CREATE TEMP TABLE {name} AS SELECT {column} AS id FROM {table} LIMIT 0;".format(name=name, column=column, table=table), prepare=False, explain=False)
+                self._copy_expert(cursor, "COPY {name} (id) FROM STDIN;".format(name=name), io.StringIO(_copy_text(ids)))
+                self._execute(cursor, "ANALYZE {name};".format(name=name), prepare=False, explain=False)
+            try:
+                yield "{target} IN (SELECT id FROM {name})".format(target=target, name=name), ()
+            finally:
+                if not connection.closed:
+                    with connection.cursor() as cursor:
+                        self._execute(cursor, "DROP TABLE IF EXISTS {name};".format(name=name), prepare=False, explain=False)
 
     # returns the number of rows from a table. 
     # "condition" can apply a condition. "WHERE column = value" is all we currently accept
     # "nonnull" is the name of a column, if you wish to only count rows where this column is not null
+    @_borrows_connection
     def get_count_from_table(self, table, condition=None, nonnull=None):
         sql = "SELECT COUNT(*) FROM {table}".format(table=table)
         if condition is not None:
@@ -128,117 +878,109 @@ class Ceritas_Database:
             if nonnull is not None:
                 sql = sql + " WHERE {} IS NOT NULL".format(nonnull)
                 
-        self.cursor.execute(sql, val)
+        self._execute(self.cursor, sql, val)
         result = self.fetchall()
         return result[0][0]
 
     # returns all product_id's associated with customers. can fill in column parameter to get other or all columns
-    def get_all_customer_products(self, column=None):
-        self.cursor.execute("SELECT id FROM groups WHERE is_default = true;")
-        default_groups = self.fetchall()
-
-        product_instance_ids = tuple()
-
-        for group in default_groups:
-            self.cursor.execute("SELECT product_instance_id FROM product_instance_group WHERE group_id = %s;", (group[0],))
-            result = self.fetchall()
-            for item in result:
-                product_instance_ids = product_instance_ids + item
-
-        self.cursor.execute("SELECT product_id FROM product_instances WHERE id in %s;", (product_instance_ids,))
-        result = self.fetchall()
-        items = []
-        for item in result:
-            items.append(item[0])
-
-        products = self.get_product_info_by_id(items, column or "id")
-        return products
+    @_borrows_connection
+    def get_all_customer_products(self, column=None, format=None):
+        column_txt = self.list_to_sql(column)
+        return self._fetch(CUSTOMER_PRODUCTS_SQL.format(column=column_txt or "id", where=""), (), format)
 
     # returns all product_ids for a specific customer. can select specific columns besides product_id to fetch
-    def get_one_customer_products(self, customer, column=None):
+    @_borrows_connection
+    def get_one_customer_products(self, customer, column=None, format=None):
         column_txt = self.list_to_sql(column)
+        return self._fetch(CUSTOMER_PRODUCTS_SQL.format(column=column_txt or "id", where=" AND g.name = %s"), (customer,), format)
 
-        self.cursor.execute("SELECT id FROM groups WHERE is_default = true AND name = %s;", (customer,))
-        default_groups = self.fetchall()
-
-        if len(default_groups) > 0:
-            product_instance_ids = tuple()
-    
-            for group in default_groups:
-                self.cursor.execute("SELECT product_instance_id FROM product_instance_group WHERE group_id = %s;", (group[0],))
-                result = self.fetchall()
-                for item in result:
-                    product_instance_ids = product_instance_ids + item
-    
-            self.cursor.execute("SELECT product_id FROM product_instances WHERE id in %s;", (product_instance_ids,))
-            result = self.fetchall()
-            items = []
-            for item in result:
-                items.append(item[0])
-    
-            products = self.get_product_info_by_id(items, column or "id")
-        else:
-            products = []
+    # bulk version of get_one_customer_products. customers: customer name or list of names
+    # returns {customer: [product, ...]} with every name passed in. customers without products (or without default groups) get an empty list
+    @_borrows_connection
+    def get_customers_products(self, customers, column=None):
+        if type(customers) is not list: customers = [ customers ]
+        if column is None:
+            column = [ "id" ]
+        elif type(column) is not list:
+            column = [ column ]
+        column_txt = ", ".join("p." + name for name in column)
+
+        products = {customer: [] for customer in customers}
+        for ids, params in self._id_filters("groups", "name", customers, split=True, alias="g"):
+            self._execute(self.cursor, CUSTOMERS_PRODUCTS_SQL.format(column=column_txt, ids=ids), params)
+            names = [description[0] for description in self.cursor.description[1:]]
+            for row in self.cursor:
+                products[row[0]].append(dict(zip(names, row[1:])))
         return products
 
     # core_product_id: id or list of id's to pull product info from
     # column: string or list of strings, specifying which columns to pull down. if blank, all columns are pulled down.
-    def get_product_info_by_id(self, core_product_id, column=None):
+    @_borrows_connection
+    def get_product_info_by_id(self, core_product_id, column=None, format=None):
         column_txt = self.list_to_sql(column)
         if type(core_product_id) is not list: core_product_id = [ core_product_id ]
-        product_tuple = tuple(core_product_id)
 
-        self.dict_cursor.execute("SELECT {column} FROM core_products WHERE id IN %s;".format(column=column_txt or "*"), (product_tuple,))
-        return self.dict_cursor.fetchall()
+        return self._fetch_many((("SELECT {column} FROM core_products WHERE {ids};".format(column=column_txt or "*", ids=ids), params)
+                for ids, params in self._id_filters("core_products", "id", core_product_id, split=True)), format)
 
     # uuid: uuid or list of uuid's to pull product info from
     # column: string or list of strings, specifying which columns to pull down. if blank, all columns are pulled down.
-    def get_product_info_by_uuid(self, uuid, column=None):
+    @_borrows_connection
+    def get_product_info_by_uuid(self, uuid, column=None, format=None):
         column_txt = self.list_to_sql(column)
         if type(uuid) is not list: uuid = [ uuid ]
-        uuid_tuple = tuple(uuid)
 
-        self.dict_cursor.execute("SELECT {column} FROM core_products WHERE uuid IN %s;".format(column=column_txt or "*"), (uuid_tuple,))
-        return self.dict_cursor.fetchall()
+        return self._fetch_many((("SELECT {column} FROM core_products WHERE {ids};".format(column=column_txt or "*", ids=ids), params)
+                for ids, params in self._id_filters("core_products", "uuid", uuid, split=True)), format)
 
     # no inputs. grabs all core_product_ids which are linked to nvd_products
-    def get_vulnerable_products(self, column=None):
-        self.cursor.execute("SELECT core_product_id FROM nvd_products WHERE core_product_id IS NOT NULL;")
+    @_borrows_connection
+    def get_vulnerable_products(self, column=None, format=None):
+        self._execute(self.cursor, "SELECT core_product_id FROM nvd_products WHERE core_product_id IS NOT NULL;")
         result = self.fetchall()
         product_id_list = []
         for item in result:
             product_id_list.append(item[0])
 
-        products = self.get_product_info_by_id(product_id_list, column or "id")
+        products = self.get_product_info_by_id(product_id_list, column or "id", format)
         return products
 
+    # streaming version of get_vulnerable_products. see iter_all_from_table for itersize and batches
+    def iter_vulnerable_products(self, column=None, itersize=DEFAULT_ITERSIZE, batches=False):
+        column_txt = self.list_to_sql(column)
+        sql = ("SELECT {column} FROM core_products WHERE id IN "
+               "(SELECT core_product_id FROM nvd_products WHERE core_product_id IS NOT NULL);").format(column=column_txt or "id")
+        return self._stream(sql, (), itersize, batches)
+
     # product_id: product id or list of ids.
     # column: string or list of strings, column names to pull from core_rating_history table. "value" is pulled by default
-    # returns rating value for each id passed. if any product does not have a rating, their space in list will have a value of "None"
-    def get_product_rating(self, product_id, column=None):
+    # returns rating value for each id passed, in the same order. if any product does not have a rating, their space in list will have a value of "None"
+    # if column is a list, each rating is a dict of those columns instead of a single value
+    # as_dict: if True, returns {product_id: rating} instead of a list
+    @_borrows_connection
+    def get_product_rating(self, product_id, column=None, as_dict=False):
         if type(product_id) is not list: product_id = [ product_id ]
-        product_id_tuple = tuple()
-        for id in product_id:
-            product_id_tuple = product_id_tuple + (id,)
+        if len(product_id) == 0:
+            return {} if as_dict else []
 
-        self.cursor.execute("SELECT current_rating_history_id FROM core_products WHERE id IN %s;", (product_id_tuple,))
-        result = self.fetchall()
+        columns = column if type(column) is list else [ column or "value" ]
+        ratings = {}
+        for ids, params in self._id_filters("core_products", "id", product_id, split=True, alias="p"):
+            self._execute(self.cursor, PRODUCT_RATING_SQL.format(columns=", ".join("h." + name for name in columns), ids=ids), params)
 
-        core_rating_history_ids = tuple()
-        for item in result:
-            core_rating_history_ids = core_rating_history_ids + item
+            for row in self.cursor:
+                if type(column) is list:
+                    ratings[row[0]] = dict(zip(columns, row[1:]))
+                else:
+                    ratings[row[0]] = row[1]
 
-        ratings = []
-        for id in core_rating_history_ids:
-            if id is not None:
-                self.execute("SELECT {column} FROM core_rating_history WHERE id IN %s;".format(column=column or "value"), (core_rating_history_ids,))
-                result = self.fetchone()[0]
-                ratings.append(result)
-            else:
-                ratings.append(None)
+        if as_dict:
+            return {id: ratings.get(id) for id in product_id}
+        return [ratings.get(id) for id in product_id]
 
-        return ratings
-        
+    # returns the nvd_product linked to core_product_id, or -1. a core product linked to several nvd_products gets the lowest nvd_product id,
+    # the same one rate_core_product_bulk and rate_core_product_parallel rate it on
+    @_borrows_connection
     def get_nvd_product_from_core_product(self, core_product_id, column=None):
         column_txt = self.list_to_sql(column)
         if type(core_product_id) is not list: core_product_id = [ core_product_id ]
@@ -246,7 +988,7 @@ class Ceritas_Database:
         for id in core_product_id:
             product_id_tuple = product_id_tuple + (id,)
             
-        self.cursor.execute("SELECT {column} FROM nvd_products WHERE core_product_id = %s;".format(column=column_txt or "id"), (product_id_tuple,))
+        self._execute(self.cursor, "SELECT {column} FROM nvd_products WHERE core_product_id = %s ORDER BY id LIMIT 1;".format(column=column_txt or "id"), (product_id_tuple,))
         result = self.fetchone()
         if result is not None:
             return result[0]
@@ -256,117 +998,196 @@ class Ceritas_Database:
     # pass in product_id: get all vulnerabilities connected to this product
     # pass in list of product_id: get all vulnerabilities for list of products
     # pass in nothing for product_id: vulnerabilities for all core products
-    def get_product_vulnerability_ids(self, product_id=None):
+    # by_product: if True, returns a dict of {product_id: [nvd_cve_id, ...]} instead of one flat list
+    @_borrows_connection
+    def get_product_vulnerability_ids(self, product_id=None, by_product=False):
         if product_id is not None:
             if type(product_id) is not list: product_id = [ product_id ]
-            product_id_tuple = tuple()
-            for id in product_id:
-                product_id_tuple = product_id_tuple + (id,)
-            
-            self.cursor.execute("SELECT id FROM nvd_products WHERE core_product_id IN %s;", (product_id_tuple,))
-        else:
-            self.cursor.execute("SELECT id FROM nvd_products WHERE core_product_id IS NOT NULL;")
+            if len(product_id) == 0:
+                return {} if by_product else -1
 
-        result = self.fetchall()
-        nvd_product_ids = tuple()
-        for item in result:
-            nvd_product_ids = nvd_product_ids + item
-        
-        if len(nvd_product_ids) > 0:
-            self.cursor.execute("SELECT id FROM nvd_cpe_matches WHERE nvd_product_id in %s", (nvd_product_ids,))
-            result = self.fetchall()
-            
-            nvd_cpe_match_ids = tuple()
-            for item in result:
-                nvd_cpe_match_ids = nvd_cpe_match_ids + item
+        result = self._walk_vulnerability_graph("core_product_id", product_id, by_product)
+        if by_product and product_id is not None:
+            return {id: result.get(id, []) for id in product_id}
+        return result
 
-            self.cursor.execute("SELECT nvd_configuration_id FROM nvd_cpe_match_configuration WHERE nvd_cpe_match_id IN %s", (nvd_cpe_match_ids,))
-            result = self.fetchall()
-            
-            nvd_configuration_ids = tuple()
-            for item in result:
-                nvd_configuration_ids = nvd_configuration_ids + item
+    # nvd_product_id: nvd product id or list of ids
+    # by_product: if True, returns a dict of {nvd_product_id: [nvd_cve_id, ...]} instead of one flat list
+    @_borrows_connection
+    def get_nvd_product_vulnerability_ids(self, nvd_product_id, by_product=False):
+        if type(nvd_product_id) is not list: nvd_product_id = [ nvd_product_id ]
+        if len(nvd_product_id) == 0:
+            return {} if by_product else []
 
-            self.cursor.execute("SELECT nvd_cve_id FROM nvd_configuration_cve WHERE nvd_configuration_id IN %s;", (nvd_configuration_ids,))
-            result = self.fetchall()
-            
-            nvd_cve_id_list = []
-            for item in result:
-                nvd_cve_id_list.append(item[0])
+        result = self._walk_vulnerability_graph("id", nvd_product_id, by_product)
+        if by_product:
+            return {id: result.get(id, []) for id in nvd_product_id}
+        if result == -1:
+            return []
+        return result
 
-            return nvd_cve_id_list
+    # walks nvd_products -> nvd_cpe_matches -> nvd_cpe_match_configuration -> nvd_configuration_cve in one statement.
+    # key: nvd_products column that ids are matched on, and that results are grouped by when by_product is True
+    # ids: list of key values, or None for every nvd_product with a non null key
+    # flat results keep the old semantics: every nvd_configuration_cve row of every configuration reached, or -1 if no nvd_products matched
+    def _walk_vulnerability_graph(self, key, ids, by_product):
+        if ids is None:
+            filters = [("{} IS NOT NULL".format(key), ())]
         else:
-            return -1
-            
-    def get_nvd_product_vulnerability_ids(self, nvd_product_id):
-        self.cursor.execute("SELECT id FROM nvd_cpe_matches WHERE nvd_product_id = %s", (nvd_product_id,))
-        result = self.fetchall()
-        
-        nvd_cpe_match_ids = tuple()
-        for item in result:
-            nvd_cpe_match_ids = nvd_cpe_match_ids + item
-
-        self.cursor.execute("SELECT nvd_configuration_id FROM nvd_cpe_match_configuration WHERE nvd_cpe_match_id IN %s", (nvd_cpe_match_ids,))
-        result = self.fetchall()
-        
-        nvd_configuration_ids = tuple()
-        for item in result:
-            nvd_configuration_ids = nvd_configuration_ids + item
-
-        self.cursor.execute("SELECT nvd_cve_id FROM nvd_configuration_cve WHERE nvd_configuration_id IN %s;", (nvd_configuration_ids,))
-        result = self.fetchall()
-        
-        nvd_cve_id_list = []
-        for item in result:
-            nvd_cve_id_list.append(item[0])
+            filters = self._id_filters("nvd_products", key, ids, split=by_product)
+        if by_product:
+            vulnerabilities = {}
+            for where_sql, params in filters:
+                self._walk_by_product(key, where_sql, params, vulnerabilities)
+            return vulnerabilities
 
+        # a single statement. the loop keeps a temporary id table alive while it runs
+        for where_sql, params in filters:
+            self._execute(self.cursor, VULNERABILITY_IDS_SQL.format(where=where_sql), params)
+            found, nvd_cve_id_list = self.fetchone()
+        if not found:
+            return -1
         return nvd_cve_id_list
 
-    # nvd_cve_id: an nvd_cve_id or list of ids.
+    # runs the by_product walk for one id filter and adds its rows to vulnerabilities
+    def _walk_by_product(self, key, where_sql, params, vulnerabilities):
+        self._execute(self.cursor, VULNERABILITIES_BY_PRODUCT_SQL.format(key=key, where=where_sql), params)
+        for product, cve_id in self.cursor:
+            cve_ids = vulnerabilities.setdefault(product, [])
+            if cve_id is not None:
+                cve_ids.append(cve_id)
+
+    # nvd_cve_id: an nvd_cve_id or list of ids. an empty list returns no rows, such as the CVEs of an nvd product that has none
     # column: column name or list of names. optional. specifies specific columns to pull rather than all
-    def get_cve_info_by_id(self, nvd_cve_id, column=None):
+    @_borrows_connection
+    def get_cve_info_by_id(self, nvd_cve_id, column=None, format=None):
         column_txt = self.list_to_sql(column)
         if type(nvd_cve_id) is not list: nvd_cve_id = [ nvd_cve_id ]
-        nvd_cve_tuple = tuple(nvd_cve_id)
+        if self._cve_cache is not None and len(nvd_cve_id) > 0:
+            return self._cached_cves(nvd_cve_id, column, self._cve_cache.get, "id", format)
 
-        if len(nvd_cve_tuple) > 0:
-            self.dict_cursor.execute("SELECT {column} FROM nvd_cves WHERE id IN %s;".format(column=column_txt or "*"), (nvd_cve_tuple,))
-            return self.dict_cursor.fetchall()
-        else:
-            return -1
+        return self._fetch_many((("SELECT {column} FROM nvd_cves WHERE {ids};".format(column=column_txt or "*", ids=ids), params)
+                for ids, params in self._id_filters("nvd_cves", "id", nvd_cve_id, split=True)), format)
+
+    # streaming version of get_cve_info_by_id. see iter_all_from_table for itersize and batches
+    def iter_cve_info_by_id(self, nvd_cve_id, column=None, itersize=DEFAULT_ITERSIZE, batches=False):
+        column_txt = self.list_to_sql(column)
+        if type(nvd_cve_id) is not list: nvd_cve_id = [ nvd_cve_id ]
+        if len(nvd_cve_id) == 0:
+            return iter(())
+        return self._stream_many(lambda connection: (("SELECT {column} FROM nvd_cves WHERE {ids};".format(column=column_txt or "*", ids=ids), params)
+                for ids, params in self._id_filters("nvd_cves", "id", nvd_cve_id, split=True, connection=connection)), itersize, batches)
 
     # cve: cve string, for example: "CVE-2022-2222"
     # column: column name or list of names. optional. pull specific columns, or all columns if blank
-    def get_cve_info_by_name(self, cve, column=None):
+    @_borrows_connection
+    def get_cve_info_by_name(self, cve, column=None, format=None):
         column_txt = self.list_to_sql(column)
         if type(cve) is not list: cve = [ cve ]
-        cve = tuple(cve)
+        if self._cve_cache is not None and len(cve) > 0:
+            return self._cached_cves(cve, column, self._cve_cache.get_by_name, "cve", format)
+
+        return self._fetch_many((("SELECT {column} FROM nvd_cves WHERE {ids};".format(column=column_txt or "*", ids=ids), params)
+                for ids, params in self._id_filters("nvd_cves", "cve", cve, split=True)), format)
 
-        self.dict_cursor.execute("SELECT {column} FROM nvd_cves WHERE cve IN %s;".format(column=column_txt or "*"), (cve,))
-        return self.dict_cursor.fetchall()
+    # looks keys up in the CVE cache and fetches every miss with one query. rows come back once per distinct key found, in input order
+    # lookup: cache lookup function for the key type. key_column: nvd_cves column the keys are matched on
+    def _cached_cves(self, keys, column, lookup, key_column, format=None):
+        rows = {}
+        misses = []
+        for key in keys:
+            if key in rows:
+                continue
+            row = lookup(key)
+            if row is None:
+                misses.append(key)
+            rows[key] = row
+
+        if len(misses) > 0:
+            for ids, params in self._id_filters("nvd_cves", key_column, misses, split=True):
+                self._execute(self.dict_cursor, "SELECT * FROM nvd_cves WHERE {ids};".format(ids=ids), params)
+                for row in self.dict_cursor.fetchall():
+                    row = dict(row)
+                    self._cve_cache.put(row)
+                    rows[row[key_column]] = row
+
+        found = [row for row in rows.values() if row is not None]
+        if column is None:
+            names = list(found[0].keys()) if len(found) > 0 else []
+        else:
+            names = column if type(column) is list else [ column ]
+        if format is None or format == "rows":
+            return [{name: row[name] for name in names} for row in found]
+        return to_format(names, [tuple(row[name] for name in names) for row in found], format)
 
     # given a product_id (or list of ids), return severity score of each CVE associated with the product.
     # returns severities as a list of values
     # for use with rating algorithm
+    @_borrows_connection
     def get_all_severities_for_product(self, product_id):
         cve_ids = self.get_product_vulnerability_ids(product_id)
+        if cve_ids == -1 or len(cve_ids) == 0:
+            return []
         severities = self.get_cve_info_by_id(cve_ids, 'severity')
         return [item['severity'] for item in severities]
 
-    def get_nvd_vendor_by_name(self, cpe_vendor, column=None):
+    # bulk version of get_all_severities_for_product, in one query for any number of core products.
+    # returns one list of severities per product, in input order, ready to be used as a dataframe column.
+    # products without nvd_products or CVEs get an empty list
+    # aggregates: if True, returns a row per product instead, with its severities and the aggregates:
+    #   core_product_id, severities, count (number of CVEs), max_severity,
+    #   low_sum, high_sum, critical_sum (weighted severity sum of the CVEs in each band, see weighted_severity), weighted_sum (all bands)
+    # format: result format of the aggregate rows, see to_format
+    @_borrows_connection
+    def get_severities_for_products(self, product_ids, aggregates=False, format=None):
+        if type(product_ids) is not list: product_ids = [ product_ids ]
+        found = {}
+        if len(product_ids) > 0:
+            for ids, params in self._id_filters("nvd_products", "core_product_id", product_ids, split=True):
+                self._execute(self.cursor,
+                    "WITH products AS (SELECT DISTINCT core_product_id AS key, id FROM nvd_products WHERE {ids}), "
+                    "cves AS ("
+                    "SELECT DISTINCT p.key, cc.nvd_cve_id FROM products p "
+                    "JOIN nvd_cpe_matches m ON m.nvd_product_id = p.id "
+                    "JOIN nvd_cpe_match_configuration mc ON mc.nvd_cpe_match_id = m.id "
+                    "JOIN nvd_configuration_cve cc ON cc.nvd_configuration_id = mc.nvd_configuration_id) "
+                    "SELECT cves.key, ARRAY_AGG(c.severity ORDER BY c.id), COUNT(*), MAX(c.severity), "
+                    "COALESCE(SUM(c.severity::float8 * %s) FILTER (WHERE c.severity::float8 < 7.0), 0.0), "
+                    "COALESCE(SUM(c.severity::float8 * %s) FILTER (WHERE c.severity::float8 >= 7.0 AND c.severity::float8 < 9.0), 0.0), "
+                    "COALESCE(SUM(c.severity::float8 * %s) FILTER (WHERE c.severity::float8 >= 9.0), 0.0) "
+                    "FROM cves JOIN nvd_cves c ON c.id = cves.nvd_cve_id GROUP BY cves.key;".format(ids=ids),
+                    params + (LOW_WEIGHT, HIGH_WEIGHT, CRITICAL_WEIGHT))
+                for row in self.cursor:
+                    found[row[0]] = row[1:]
+
+        if not aggregates:
+            return [list(found[id][0]) if id in found else [] for id in product_ids]
+        names = ["core_product_id", "severities", "count", "max_severity", "low_sum", "high_sum", "critical_sum", "weighted_sum"]
+        rows = []
+        for id in product_ids:
+            if id in found:
+                severities, count, max_severity, low_sum, high_sum, critical_sum = found[id]
+                rows.append((id, list(severities), count, max_severity, low_sum, high_sum, critical_sum, low_sum + high_sum + critical_sum))
+            else:
+                rows.append((id, [], 0, None, 0.0, 0.0, 0.0, 0.0))
+        return to_format(names, rows, format)
+
+    @_borrows_connection
+    def get_nvd_vendor_by_name(self, cpe_vendor, column=None, format=None):
         column_txt = self.list_to_sql(column)
-        self.dict_cursor.execute("SELECT {column} FROM nvd_vendors WHERE cpe_vendor = %s;".format(column=column_txt or "*"), (cpe_vendor,))
-        return self.dict_cursor.fetchall()
+        return self._fetch("SELECT {column} FROM nvd_vendors WHERE cpe_vendor = %s;".format(column=column_txt or "*"), (cpe_vendor,), format)
 
-    def get_all_nvd_products_by_vendor(self, cpe_vendor, column=None):
+    @_borrows_connection
+    def get_all_nvd_products_by_vendor(self, cpe_vendor, column=None, format=None):
         column_txt = self.list_to_sql(column)
         vendor = self.get_nvd_vendor_by_name(cpe_vendor, "id")
         nvd_vendor_id = vendor[0]['id']
-        self.dict_cursor.execute("SELECT {column} FROM nvd_products WHERE nvd_vendor_id = %s;".format(column=column_txt or "*"), (nvd_vendor_id,))
-        return self.dict_cursor.fetchall()
+        return self._fetch("SELECT {column} FROM nvd_products WHERE nvd_vendor_id = %s;".format(column=column_txt or "*"), (nvd_vendor_id,), format)
         
     # need to write logic for components as well
+    @_borrows_connection
     def rate_core_product(self, core_product_ids):
+        if type(core_product_ids) is not list: core_product_ids = [ core_product_ids ]
         ratings = []
         for product in core_product_ids:
             nvd_product_id = self.get_nvd_product_from_core_product(product)
@@ -377,6 +1198,7 @@ class Ceritas_Database:
             ratings.extend(rating)
         return ratings
         
+    @_borrows_connection
     def rate_nvd_product(self, nvd_product_ids):
         ratings = []
         if type(nvd_product_ids) is not list: nvd_product_ids = [ nvd_product_ids ]
@@ -387,34 +1209,301 @@ class Ceritas_Database:
             severity_sum_weighted = 0.0
             
             for score in severities:
-                score = float(score['severity'])
-                if score >= 7.0:
-                    if score >= 9.0:
-                        severity_weighted = score * CRITICAL_WEIGHT
-                    else:
-                        severity_weighted = score * HIGH_WEIGHT
-                else:
-                    severity_weighted = score * LOW_WEIGHT
-                severity_sum_weighted = severity_sum_weighted + severity_weighted
-                
-            if severity_sum_weighted > MAX_SEVERITY:
-                        severity_sum_weighted = MAX_SEVERITY
-                    
-            normal_numerator = severity_sum_weighted - MINIMUM_SEVERITY
-            normal_denominator = MAX_SEVERITY - MINIMUM_SEVERITY
-            
-            product_severity = (normal_numerator / normal_denominator) * 10
-            
-            if product_severity > ATTENTION_CUTOFF:
-                if product_severity > CAUTION_CUTOFF:
-                    if product_severity > ALERT_CUTOFF:
-                        product_rating = 100
-                    else:
-                        product_rating = 150
+                severity_sum_weighted = severity_sum_weighted + weighted_severity(score['severity'])
+
+            ratings.append(rating_from_severity_sum(severity_sum_weighted))
+        return ratings
+
+    # bulk version of rate_core_product. rates any number of core products with one query, ratings come back in input order.
+    # severities are weighted and summed per product in sql, the sums go through the same cutoffs as rate_core_product.
+    # products linked to several nvd_products are rated on the lowest nvd_product id
+    @_borrows_connection
+    def rate_core_product_bulk(self, core_product_ids):
+        if type(core_product_ids) is not list: core_product_ids = [ core_product_ids ]
+        sums = self._weighted_severity_sums("core_product_id", core_product_ids)
+        return [rating_from_severity_sum(sums[id]) if id in sums else 250 for id in core_product_ids]
+
+    # bulk version of rate_nvd_product. one query for any number of nvd products, ratings come back in input order
+    @_borrows_connection
+    def rate_nvd_product_bulk(self, nvd_product_ids):
+        if type(nvd_product_ids) is not list: nvd_product_ids = [ nvd_product_ids ]
+        sums = self._weighted_severity_sums("id", nvd_product_ids)
+        return [rating_from_severity_sum(sums.get(id, 0.0)) for id in nvd_product_ids]
+
+    # incremental rating. finds the core products linked to CVEs whose nvd_cves.date_modified is at or after since - lag,
+    # and rates only those, with rate_core_product_bulk. since=None rates every core product linked to an nvd product, with or without CVEs.
+    # returns (ratings, watermark): ratings is {core_product_id: rating}, watermark is the latest date_modified seen
+    # (or "since" if nothing newer changed), to pass as "since" on the next run.
+    # lag: overlap with the previous run. a sync transaction that commits after a run, with date_modified values older than that run's
+    # watermark, is still picked up on the next run if it committed within lag. products in the overlap are rated again, which is harmless.
+    # changes to the link tables alone (a new cpe match or configuration for an old CVE) don't move date_modified and are not picked up
+    @_borrows_connection
+    def rate_changed_core_products(self, since=None, lag=WATERMARK_LAG):
+        if since is None:
+            self._execute(self.cursor,
+                "SELECT (SELECT MAX(date_modified) FROM nvd_cves), ARRAY("
+                "SELECT DISTINCT core_product_id FROM nvd_products WHERE core_product_id IS NOT NULL);")
+        else:
+            self._execute(self.cursor,
+                "WITH changed AS (SELECT id, date_modified FROM nvd_cves WHERE date_modified >= %s) "
+                "SELECT (SELECT MAX(date_modified) FROM changed), ARRAY("
+                "SELECT DISTINCT np.core_product_id FROM changed c "
+                "JOIN nvd_configuration_cve cc ON cc.nvd_cve_id = c.id "
+                "JOIN nvd_cpe_match_configuration mc ON mc.nvd_configuration_id = cc.nvd_configuration_id "
+                "JOIN nvd_cpe_matches m ON m.id = mc.nvd_cpe_match_id "
+                "JOIN nvd_products np ON np.id = m.nvd_product_id "
+                "WHERE np.core_product_id IS NOT NULL);",
+                (since - lag,))
+        watermark, core_product_ids = self.fetchone()
+
+        ratings = dict(zip(core_product_ids, self.rate_core_product_bulk(core_product_ids)))
+        if since is not None and (watermark is None or watermark < since):
+            watermark = since
+        return ratings, watermark
+
+    # writes ratings back. for each product, inserts a core_rating_history row and points core_products.current_rating_history_id at it.
+    # ratings: {core_product_id: value}, or a list of (core_product_id, value) pairs, such as zip(ids, db.rate_core_product_bulk(ids)).
+    # if a product is listed twice, its last value is written
+    # each batch of batch_size products is one multi-row statement (execute_values), committed on its own. with commit=False nothing is committed,
+    # and the whole write stays in the caller's transaction
+    # product_column: core_rating_history column that holds the product id
+    # returns {core_product_id: new core_rating_history id}
+    # if a batch fails, raises RatingWriteError with the ids of the batches committed before it. with commit=True the failed batch is rolled back,
+    # with commit=False rolling back is left to the caller
+    @_borrows_connection
+    def write_product_ratings(self, ratings, batch_size=DEFAULT_WRITE_BATCH, commit=True, product_column="core_product_id"):
+        if type(ratings) is not dict: ratings = dict(ratings)
+        rows = list(ratings.items())
+
+        history_ids = {}
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            try:
+                written = self._execute_values(self.cursor,
+                    "WITH new AS ("
+                    "INSERT INTO core_rating_history ({product}, value) VALUES %s RETURNING id, {product} AS product_id), "
+                    "updated AS ("
+                    "UPDATE core_products p SET current_rating_history_id = new.id FROM new WHERE p.id = new.product_id) "
+                    "SELECT product_id, id FROM new;".format(product=product_column),
+                    batch, batch_size)
+                if commit:
+                    self.connection.commit()
+            except Exception as error:
+                if not commit:
+                    raise RatingWriteError({}, rows[start:]) from error
+                if not self.connection.closed:
+                    self.connection.rollback()
+                raise RatingWriteError(history_ids, rows[start:]) from error
+            history_ids.update(written)
+        return history_ids
+
+    # rates core products across a pool of worker processes. the id list is cut into shards of chunk_size products,
+    # each worker opens its own connection with this instance's credentials and rates whole shards.
+    # ratings come back in input order, the same as rate_core_product (or rate_core_product_bulk if bulk is True) would return.
+    # workers: number of processes, defaults to the number of cpus.
+    # if any shard fails, raises ParallelRatingError once every shard has finished, holding the partial ratings and the error of each failed shard
+    def rate_core_product_parallel(self, core_product_ids, workers=None, chunk_size=DEFAULT_RATING_CHUNK, bulk=False):
+        if type(core_product_ids) is not list: core_product_ids = list(core_product_ids)
+        shards = [core_product_ids[start:start + chunk_size] for start in range(0, len(core_product_ids), chunk_size)]
+        ratings = [None] * len(core_product_ids)
+        failures = {}
+        if len(shards) == 0:
+            return ratings
+
+        with ProcessPoolExecutor(max_workers=workers or min(os.cpu_count() or 1, len(shards)),
+                initializer=_init_rating_worker,
+                initargs=(self._connect_args,)) as executor:
+            futures = {executor.submit(_rate_shard, shard, bulk): index for index, shard in enumerate(shards)}
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    error, result = future.result()
+                except Exception:
+                    error, result = traceback.format_exc(), None
+                if error is not None:
+                    failures[index] = error
                 else:
-                    product_rating = 200
+                    ratings[index * chunk_size:index * chunk_size + len(result)] = result
+
+        if len(failures) > 0:
+            raise ParallelRatingError(ratings, failures, shards)
+        return ratings
+
+    # returns {key: weighted severity sum} for the nvd_products whose "key" column is in ids, see WEIGHTED_SEVERITY_SUMS_SQL.
+    # each distinct CVE reachable from a product is counted once, same as get_cve_info_by_id in rate_nvd_product
+    def _weighted_severity_sums(self, key, ids):
+        sums = {}
+        if len(ids) == 0:
+            return sums
+        for ids_sql, params in self._id_filters("nvd_products", key, ids, split=True):
+            self._execute(self.cursor, WEIGHTED_SEVERITY_SUMS_SQL.format(key=key, ids=ids_sql), params + WEIGHT_PARAMS)
+            sums.update(self.fetchall())
+        return sums
+
+
+# raised by rate_core_product_parallel when shards fail.
+# ratings: ratings in input order, None for products of failed shards. failures: {shard index: traceback text}. shards: the id lists
+class ParallelRatingError(Exception):
+    def __init__(self, ratings, failures, shards):
+        super().__init__("{} of {} rating shards failed".format(len(failures), len(shards)))
+        self.ratings = ratings
+        self.failures = failures
+        self.shards = shards
+
+# raised by write_product_ratings when a batch fails, chained to the error.
+# history_ids: {core_product_id: core_rating_history id} of the batches committed before it, empty with commit=False.
+# unwritten: (core_product_id, value) pairs of the failed batch and the ones after it
+class RatingWriteError(Exception):
+    def __init__(self, history_ids, unwritten):
+        super().__init__("{} ratings written, {} not written".format(len(history_ids), len(unwritten)))
+        self.history_ids = history_ids
+        self.unwritten = unwritten
+
+# connection held by each rate_core_product_parallel worker process
+_worker_db = None
+
+def _init_rating_worker(connect_args):
+    global _worker_db
+    _worker_db = Ceritas_Database(**connect_args)
+
+# returns (error, ratings). errors come back as traceback text, as not every driver exception survives pickling
+def _rate_shard(core_product_ids, bulk):
+    try:
+        if bulk:
+            ratings = _worker_db.rate_core_product_bulk(core_product_ids)
+        else:
+            ratings = _worker_db.rate_core_product(core_product_ids)
+        _worker_db.commit()
+        return None, ratings
+    except Exception:
+        if _worker_db is not None and not _worker_db.connection.closed:
+            _worker_db.connection.rollback()
+        return traceback.format_exc(), None
+
+# weights one CVE severity score by its band (low, high or critical)
+def weighted_severity(score):
+    score = float(score)
+    if score >= 7.0:
+        if score >= 9.0:
+            return score * CRITICAL_WEIGHT
+        else:
+            return score * HIGH_WEIGHT
+    else:
+        return score * LOW_WEIGHT
+
+# turns a product's summed weighted severities into a rating of 100 (alert), 150 (caution), 200 (attention) or 250 (none)
+def rating_from_severity_sum(severity_sum_weighted):
+    if severity_sum_weighted > MAX_SEVERITY:
+        severity_sum_weighted = MAX_SEVERITY
+
+    normal_numerator = severity_sum_weighted - MINIMUM_SEVERITY
+    normal_denominator = MAX_SEVERITY - MINIMUM_SEVERITY
+
+    product_severity = (normal_numerator / normal_denominator) * 10
+
+    if product_severity > ATTENTION_CUTOFF:
+        if product_severity > CAUTION_CUTOFF:
+            if product_severity > ALERT_CUTOFF:
+                product_rating = 100
             else:
-                product_rating = 250
-                
-            ratings.append(product_rating)
-        return ratings
\ No newline at end of file
+                product_rating = 150
+        else:
+            product_rating = 200
+    else:
+        product_rating = 250
+
+    return product_rating
+
+# result formats accepted by the "format" argument of the get_* readers:
+#   None or "rows": list of dicts, one per row (the default)
+#   "columns": dict of column name -> list of values
+#   "numpy": dict of column name -> numpy array
+#   "dataframe": pandas DataFrame
+#   "arrow": pyarrow Table
+# the columnar formats are built straight from tuple rows, without a dict per row.
+# numpy, dataframe and arrow results turn numeric (Decimal) columns into floats
+RESULT_FORMATS = ("rows", "columns", "numpy", "dataframe", "arrow")
+
+# names: column names. rows: list of tuples in the same column order
+def to_format(names, rows, format):
+    if format is None or format == "rows":
+        return [dict(zip(names, row)) for row in rows]
+    if format not in RESULT_FORMATS:
+        raise ValueError("unknown result format {}, expected one of {}".format(format, ", ".join(RESULT_FORMATS)))
+
+    if len(rows) > 0:
+        columns = [list(values) for values in zip(*rows)]
+    else:
+        columns = [[] for name in names]
+    if format == "columns":
+        return dict(zip(names, columns))
+
+    columns = [_decimals_to_float(values) for values in columns]
+    if format == "numpy":
+        import numpy
+        return {name: _numpy_column(numpy, values) for name, values in zip(names, columns)}
+    if format == "dataframe":
+        import pandas
+        return pandas.DataFrame(dict(zip(names, columns)), columns=names)
+    import pyarrow
+    return pyarrow.table(dict(zip(names, columns)))
+
+# sql text with generated temporary table and prepared statement names replaced, so one template collects every call's statistics
+def _statement_template(sql):
+    return re.sub(r"(ceritas_ids|ceritas_statement)_\d+", r"\1_N", sql)
+
+# statements that read a temporary id table (see _id_filters) are never prepared: each table name is only used once,
+# and preparing them would only push hot statements out of the cache
+def _reads_temporary_table(sql):
+    return re.search(r"\bceritas_ids_\d+\b", sql) is not None
+
+# turns psycopg2 "%s" placeholders into the "$1, $2, ..." numbering PREPARE expects
+def _numbered_placeholders(sql):
+    numbers = itertools.count(1)
+    return re.sub(r"%%|%s", lambda match: "%" if match.group(0) == "%%" else "${}".format(next(numbers)), sql)
+
+# distinct ids of a list, in order, as they can be sent in an array literal or COPY. None and NaN are dropped,
+# they never match, same as with "IN %s". integral floats become ints: pandas id columns with missing values are float64.
+# other floats are dropped too, the id, uuid and name columns the filters compare them to never equal them
+def _filter_ids(ids):
+    distinct = {}
+    for value in ids:
+        if value is None:
+            continue
+        if isinstance(value, float):
+            if not value.is_integer():
+                continue
+            value = int(value)
+        distinct[value] = None
+    return list(distinct)
+
+# builds a postgres array literal ('{"1","2"}') for an id list. sent as an untyped parameter,
+# postgres casts it to an array of the compared column's type, so it works for int, text and uuid columns alike
+def _array_literal(values):
+    items = []
+    for value in values:
+        items.append('"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"')
+    return "{" + ",".join(items) + "}"
+
+# one line per value, escaped for COPY ... FROM STDIN in text format
+def _copy_text(values):
+    lines = []
+    for value in values:
+        lines.append(str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r'))
+    return "\n".join(lines) + "\n"
+
+# numpy array of one column. columns of lists (such as postgres arrays) become object arrays of lists
+def _numpy_column(numpy, values):
+    if len(values) > 0 and type(values[0]) is list:
+        column = numpy.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+    return numpy.array(values)
+
+def _decimals_to_float(values):
+    for value in values:
+        if value is not None:
+            if isinstance(value, Decimal):
+                return [None if value is None else float(value) for value in values]
+            break
+    return values
@@ -0,0 +1,245 @@
+from psycopg.rows import dict_row, tuple_row
+from psycopg_pool import AsyncConnectionPool
+
+from ceritas_data_layer import (Ceritas_Database, rating_from_severity_sum, _filter_ids, CUSTOMER_PRODUCTS_SQL, CUSTOMERS_PRODUCTS_SQL,
+        PRODUCT_RATING_SQL, VULNERABILITY_IDS_SQL, VULNERABILITIES_BY_PRODUCT_SQL, WEIGHTED_SEVERITY_SUMS_SQL, WEIGHT_PARAMS)
+
+# asyncio counterpart of Ceritas_Database, backed by a psycopg 3 async connection pool.
+# every method borrows its own connection, so independent lookups can run concurrently with asyncio.gather:
+#
+#   async with await AsyncCeritasDatabase.connect(database, user, password, host) as db:
+#       info, ratings = await asyncio.gather(db.get_product_info_by_id(ids), db.get_product_rating(ids))
+#
+# methods return the same results as their Ceritas_Database counterparts, and run the same statements. differences:
+#   id lists are always sent as one array parameter, never batched or copied to a temporary table
+#   rate_core_product and rate_nvd_product always use the one-query bulk path (the same ratings as the serial methods)
+#   there are no result formats, streaming iter_* methods, CVE cache, prepared statements or instrumentation
+class AsyncCeritasDatabase:
+    def __init__(self, pool):
+        self._pool = pool
+
+    @classmethod
+    async def connect(cls, database, user, password, host, min_size=1, max_size=10):
+        pool = AsyncConnectionPool(kwargs={'dbname': database, 'user': user, 'password': password, 'host': host},
+                min_size=min_size,
+                max_size=max_size,
+                open=False)
+        await pool.open()
+        return cls(pool)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @property
+    def pool(self):
+        return self._pool
+
+    async def close(self):
+        await self._pool.close()
+
+    # sql helpers are shared with the blocking class, they don't touch the connection
+    parse_condition = Ceritas_Database.parse_condition
+    list_to_sql = Ceritas_Database.list_to_sql
+    _table_sql = Ceritas_Database._table_sql
+
+    async def _fetchall(self, sql, params=None, dicts=False):
+        async with self._pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row if dicts else tuple_row) as cursor:
+                await cursor.execute(sql, params or ())
+                return await cursor.fetchall()
+
+    async def _fetchone(self, sql, params=None):
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, params or ())
+                return await cursor.fetchone()
+
+    # runs a statement on its own pooled connection and returns all rows as tuples. the connection is committed afterwards
+    async def query(self, sql, params=None):
+        return await self._fetchall(sql, params)
+
+    async def get_all_from_table(self, table, column=None, condition=None, nonnull=None):
+        sql, val = self._table_sql(table, column, condition, nonnull)
+        return await self._fetchall(sql, val, dicts=True)
+
+    async def get_count_from_table(self, table, condition=None, nonnull=None):
+        sql, val = self._table_sql(table, "COUNT(*)", condition, nonnull)
+        result = await self._fetchone(sql, val)
+        return result[0]
+
+    async def get_all_customer_products(self, column=None):
+        column_txt = self.list_to_sql(column)
+        return await self._fetchall(CUSTOMER_PRODUCTS_SQL.format(column=column_txt or "id", where=""), dicts=True)
+
+    async def get_one_customer_products(self, customer, column=None):
+        column_txt = self.list_to_sql(column)
+        return await self._fetchall(CUSTOMER_PRODUCTS_SQL.format(column=column_txt or "id", where=" AND g.name = %s"),
+                (customer,), dicts=True)
+
+    # see Ceritas_Database.get_customers_products
+    async def get_customers_products(self, customers, column=None):
+        if type(customers) is not list: customers = [ customers ]
+        if column is None:
+            column = [ "id" ]
+        elif type(column) is not list:
+            column = [ column ]
+        column_txt = ", ".join("p." + name for name in column)
+
+        async with self._pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(CUSTOMERS_PRODUCTS_SQL.format(column=column_txt, ids="g.name = ANY(%s)"), (_filter_ids(customers),))
+                names = [description[0] for description in cursor.description[1:]]
+                rows = await cursor.fetchall()
+
+        products = {customer: [] for customer in customers}
+        for row in rows:
+            products[row[0]].append(dict(zip(names, row[1:])))
+        return products
+
+    async def get_product_info_by_id(self, core_product_id, column=None):
+        column_txt = self.list_to_sql(column)
+        if type(core_product_id) is not list: core_product_id = [ core_product_id ]
+        return await self._fetchall("SELECT {column} FROM core_products WHERE id = ANY(%s);".format(column=column_txt or "*"),
+                (_filter_ids(core_product_id),), dicts=True)
+
+    async def get_product_info_by_uuid(self, uuid, column=None):
+        column_txt = self.list_to_sql(column)
+        if type(uuid) is not list: uuid = [ uuid ]
+        return await self._fetchall("SELECT {column} FROM core_products WHERE uuid = ANY(%s);".format(column=column_txt or "*"),
+                (_filter_ids(uuid),), dicts=True)
+
+    async def get_vulnerable_products(self, column=None):
+        column_txt = self.list_to_sql(column)
+        return await self._fetchall(
+            "SELECT {column} FROM core_products WHERE id IN "
+            "(SELECT core_product_id FROM nvd_products WHERE core_product_id IS NOT NULL);".format(column=column_txt or "id"),
+            dicts=True)
+
+    # returns ratings in the order of product_id, with None for products that have no rating. see Ceritas_Database.get_product_rating
+    async def get_product_rating(self, product_id, column=None, as_dict=False):
+        if type(product_id) is not list: product_id = [ product_id ]
+        if len(product_id) == 0:
+            return {} if as_dict else []
+
+        columns = column if type(column) is list else [ column or "value" ]
+        result = await self._fetchall(PRODUCT_RATING_SQL.format(columns=", ".join("h." + name for name in columns), ids="p.id = ANY(%s)"),
+                (_filter_ids(product_id),))
+
+        ratings = {}
+        for row in result:
+            if type(column) is list:
+                ratings[row[0]] = dict(zip(columns, row[1:]))
+            else:
+                ratings[row[0]] = row[1]
+
+        if as_dict:
+            return {id: ratings.get(id) for id in product_id}
+        return [ratings.get(id) for id in product_id]
+
+    async def get_nvd_product_from_core_product(self, core_product_id, column=None):
+        column_txt = self.list_to_sql(column)
+        result = await self._fetchone("SELECT {column} FROM nvd_products WHERE core_product_id = %s ORDER BY id LIMIT 1;".format(column=column_txt or "id"),
+                (core_product_id,))
+        if result is not None:
+            return result[0]
+        else:
+            return -1
+
+    async def get_product_vulnerability_ids(self, product_id=None, by_product=False):
+        if product_id is not None:
+            if type(product_id) is not list: product_id = [ product_id ]
+            if len(product_id) == 0:
+                return {} if by_product else -1
+            where = ("core_product_id = ANY(%s)", (_filter_ids(product_id),))
+        else:
+            where = ("core_product_id IS NOT NULL", ())
+
+        result = await self._walk_vulnerability_graph(where, "core_product_id", by_product)
+        if by_product and product_id is not None:
+            return {id: result.get(id, []) for id in product_id}
+        return result
+
+    async def get_nvd_product_vulnerability_ids(self, nvd_product_id, by_product=False):
+        if type(nvd_product_id) is not list: nvd_product_id = [ nvd_product_id ]
+        if len(nvd_product_id) == 0:
+            return {} if by_product else []
+
+        result = await self._walk_vulnerability_graph(("id = ANY(%s)", (_filter_ids(nvd_product_id),)), "id", by_product)
+        if by_product:
+            return {id: result.get(id, []) for id in nvd_product_id}
+        if result == -1:
+            return []
+        return result
+
+    # same traversal as Ceritas_Database._walk_vulnerability_graph
+    async def _walk_vulnerability_graph(self, where, key, by_product):
+        where_sql, params = where
+        if by_product:
+            result = await self._fetchall(VULNERABILITIES_BY_PRODUCT_SQL.format(key=key, where=where_sql), params)
+            vulnerabilities = {}
+            for product, cve_id in result:
+                cve_ids = vulnerabilities.setdefault(product, [])
+                if cve_id is not None:
+                    cve_ids.append(cve_id)
+            return vulnerabilities
+
+        found, nvd_cve_id_list = await self._fetchone(VULNERABILITY_IDS_SQL.format(where=where_sql), params)
+        if not found:
+            return -1
+        return nvd_cve_id_list
+
+    async def get_cve_info_by_id(self, nvd_cve_id, column=None):
+        column_txt = self.list_to_sql(column)
+        if type(nvd_cve_id) is not list: nvd_cve_id = [ nvd_cve_id ]
+        return await self._fetchall("SELECT {column} FROM nvd_cves WHERE id = ANY(%s);".format(column=column_txt or "*"),
+                (_filter_ids(nvd_cve_id),), dicts=True)
+
+    async def get_cve_info_by_name(self, cve, column=None):
+        column_txt = self.list_to_sql(column)
+        if type(cve) is not list: cve = [ cve ]
+        return await self._fetchall("SELECT {column} FROM nvd_cves WHERE cve = ANY(%s);".format(column=column_txt or "*"),
+                (_filter_ids(cve),), dicts=True)
+
+    async def get_all_severities_for_product(self, product_id):
+        cve_ids = await self.get_product_vulnerability_ids(product_id)
+        if cve_ids == -1 or len(cve_ids) == 0:
+            return []
+        severities = await self.get_cve_info_by_id(cve_ids, 'severity')
+        return [item['severity'] for item in severities]
+
+    async def get_nvd_vendor_by_name(self, cpe_vendor, column=None):
+        column_txt = self.list_to_sql(column)
+        return await self._fetchall("SELECT {column} FROM nvd_vendors WHERE cpe_vendor = %s;".format(column=column_txt or "*"),
+                (cpe_vendor,), dicts=True)
+
+    async def get_all_nvd_products_by_vendor(self, cpe_vendor, column=None):
+        column_txt = self.list_to_sql(column)
+        return await self._fetchall(
+            "SELECT {column} FROM nvd_products WHERE nvd_vendor_id = "
+            "(SELECT id FROM nvd_vendors WHERE cpe_vendor = %s LIMIT 1);".format(column=column_txt or "*"),
+            (cpe_vendor,), dicts=True)
+
+    # same ratings as Ceritas_Database.rate_core_product, computed with one query
+    async def rate_core_product(self, core_product_ids):
+        if type(core_product_ids) is not list: core_product_ids = [ core_product_ids ]
+        sums = await self._weighted_severity_sums("core_product_id", core_product_ids)
+        return [rating_from_severity_sum(sums[id]) if id in sums else 250 for id in core_product_ids]
+
+    async def rate_nvd_product(self, nvd_product_ids):
+        if type(nvd_product_ids) is not list: nvd_product_ids = [ nvd_product_ids ]
+        sums = await self._weighted_severity_sums("id", nvd_product_ids)
+        return [rating_from_severity_sum(sums.get(id, 0.0)) for id in nvd_product_ids]
+
+    rate_core_product_bulk = rate_core_product
+    rate_nvd_product_bulk = rate_nvd_product
+
+    # same sums as Ceritas_Database._weighted_severity_sums
+    async def _weighted_severity_sums(self, key, ids):
+        if len(ids) == 0:
+            return {}
+        result = await self._fetchall(WEIGHTED_SEVERITY_SUMS_SQL.format(key=key, ids="{} = ANY(%s)".format(key)),
+                (_filter_ids(ids),) + WEIGHT_PARAMS)
+        return dict(result)
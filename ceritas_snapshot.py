@@ -0,0 +1,301 @@
+import itertools
+import json
+import mmap
+import os
+from datetime import datetime
+
+import numpy
+
+from ceritas_data_layer import rating_from_severity_sum, LOW_WEIGHT, HIGH_WEIGHT, CRITICAL_WEIGHT, DEFAULT_ITERSIZE
+
+# read-only, in-memory copy of the vulnerability graph (core_product -> nvd_product -> configuration -> CVE, plus CVE severities),
+# for answering product -> CVE -> severity lookups and ratings without touching postgres.
+# the graph is held as CSR style integer arrays: for each level, a sorted id array, an offsets array and a flat array of children,
+# so the children of the i-th id are children[offsets[i]:offsets[i + 1]].
+#
+#   snapshot = VulnerabilitySnapshot.build(db_instance)
+#   snapshot.save("vulnerabilities.snap")
+#   ...
+#   snapshot = VulnerabilitySnapshot.load("vulnerabilities.snap")
+#   ratings = snapshot.rate_core_product(core_product_ids)
+#
+# load() memory-maps the file, so every process that loads the same file shares one copy in the page cache.
+# a loaded snapshot pickles as its path, so passing it to worker processes maps the file again instead of copying the arrays.
+# the snapshot is as of the time it was built. rebuild it after an NVD sync, watermark is the latest nvd_cves.date_modified it holds
+
+SNAPSHOT_MAGIC = b"CERSNAP1"
+SNAPSHOT_VERSION = 1
+
+# array data starts on multiples of this many bytes in the snapshot file
+SNAPSHOT_ALIGNMENT = 64
+
+#   core_ids: core_product_id of every nvd_product that has one, sorted. core_offsets: into core_nvd.
+#   core_nvd: indexes into nvd_ids of each core product's nvd_products, lowest nvd_product id first
+#   nvd_ids: every nvd_product id, sorted. nvd_offsets: into nvd_configurations.
+#   nvd_configurations: distinct nvd_configuration_id reached from each nvd_product through its cpe matches
+#   configuration_ids: every nvd_configuration_id in nvd_configuration_cve, sorted. configuration_offsets: into configuration_cves.
+#   configuration_cves: nvd_cve_id of every nvd_configuration_cve row of each configuration
+#   cve_ids: every nvd_cves id, sorted. cve_severities: severity of each, NaN where it is null
+SNAPSHOT_ARRAYS = (("core_ids", "<i8"), ("core_offsets", "<i8"), ("core_nvd", "<i8"),
+        ("nvd_ids", "<i8"), ("nvd_offsets", "<i8"), ("nvd_configurations", "<i8"),
+        ("configuration_ids", "<i8"), ("configuration_offsets", "<i8"), ("configuration_cves", "<i8"),
+        ("cve_ids", "<i8"), ("cve_severities", "<f8"))
+
+_snapshot_cursor_names = itertools.count()
+
+class VulnerabilitySnapshot:
+    # arrays: {name: numpy array} for every name in SNAPSHOT_ARRAYS. metadata: dict saved in the file header
+    # path: the file the arrays are mapped from, if any
+    def __init__(self, arrays, metadata, path=None):
+        missing = [name for name, dtype in SNAPSHOT_ARRAYS if name not in arrays]
+        if len(missing) > 0:
+            raise ValueError("snapshot is missing arrays: {}".format(", ".join(missing)))
+        self._arrays = arrays
+        self.metadata = metadata
+        self.path = path
+        for name, dtype in SNAPSHOT_ARRAYS:
+            setattr(self, "_" + name, arrays[name])
+
+    # reads the vulnerability graph from db (a Ceritas_Database) into a new snapshot.
+    # the tables are read on a connection of its own (see Ceritas_Database._stream_connection), in one repeatable read transaction,
+    # so the snapshot is consistent even if an NVD sync is running
+    @classmethod
+    def build(cls, db, itersize=DEFAULT_ITERSIZE):
+        with db._stream_connection() as connection:
+            connection.rollback()
+            with connection.cursor() as cursor:
+                db._execute(cursor, "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;", prepare=False, explain=False)
+            nvd = _read_columns(db, connection,
+                "SELECT id, COALESCE(core_product_id, -1) FROM nvd_products ORDER BY id;", ("<i8", "<i8"), itersize)
+            nvd_configurations = _read_columns(db, connection,
+                "SELECT DISTINCT m.nvd_product_id, mc.nvd_configuration_id FROM nvd_cpe_matches m "
+                "JOIN nvd_products p ON p.id = m.nvd_product_id "
+                "JOIN nvd_cpe_match_configuration mc ON mc.nvd_cpe_match_id = m.id "
+                "WHERE mc.nvd_configuration_id IS NOT NULL ORDER BY 1, 2;", ("<i8", "<i8"), itersize)
+            configuration_cves = _read_columns(db, connection,
+                "SELECT nvd_configuration_id, nvd_cve_id FROM nvd_configuration_cve "
+                "WHERE nvd_configuration_id IS NOT NULL AND nvd_cve_id IS NOT NULL ORDER BY 1, 2;", ("<i8", "<i8"), itersize)
+            cves = _read_columns(db, connection,
+                "SELECT id, COALESCE(severity::float8, 'NaN') FROM nvd_cves ORDER BY id;", ("<i8", "<f8"), itersize)
+            with connection.cursor() as cursor:
+                db._execute(cursor, "SELECT MAX(date_modified) FROM nvd_cves;", prepare=False)
+                watermark = cursor.fetchone()[0]
+        return cls.from_columns(nvd, nvd_configurations, configuration_cves, cves, watermark)
+
+    # builds a snapshot from the rows build() reads, as tuples of numpy arrays (the columns of each query, sorted the same way):
+    # nvd: (nvd_product id, core_product_id or -1). nvd_configurations: (nvd_product id, nvd_configuration_id).
+    # configuration_cves: (nvd_configuration_id, nvd_cve_id). cves: (nvd_cve id, severity or NaN). watermark: latest date_modified, or None
+    @classmethod
+    def from_columns(cls, nvd, nvd_configurations, configuration_cves, cves, watermark=None):
+        nvd_ids, nvd_core_ids = nvd
+        linked = numpy.flatnonzero(nvd_core_ids != -1)
+        linked = linked[numpy.argsort(nvd_core_ids[linked], kind="stable")]
+        core_ids, core_offsets = _csr(nvd_core_ids[linked])
+
+        configuration_ids, configuration_offsets = _csr(configuration_cves[0])
+        arrays = {
+            "core_ids": core_ids,
+            "core_offsets": core_offsets,
+            "core_nvd": linked,
+            "nvd_ids": nvd_ids,
+            "nvd_offsets": _csr(nvd_configurations[0], nvd_ids)[1],
+            "nvd_configurations": nvd_configurations[1],
+            "configuration_ids": configuration_ids,
+            "configuration_offsets": configuration_offsets,
+            "configuration_cves": configuration_cves[1],
+            "cve_ids": cves[0],
+            "cve_severities": cves[1],
+        }
+        metadata = {
+            "version": SNAPSHOT_VERSION,
+            "created": datetime.now().isoformat(),
+            "watermark": watermark.isoformat() if watermark is not None else None,
+        }
+        return cls(arrays, metadata)
+
+    # writes the snapshot to path. the file is written next to path and renamed over it,
+    # so processes that still have the old file mapped keep reading the old snapshot
+    def save(self, path):
+        header = dict(self.metadata, arrays={})
+        offset = 0
+        for name, dtype in SNAPSHOT_ARRAYS:
+            values = self._arrays[name]
+            header["arrays"][name] = {"dtype": dtype, "offset": offset, "length": len(values)}
+            offset = _aligned(offset + len(values) * numpy.dtype(dtype).itemsize)
+        header_bytes = json.dumps(header).encode("utf-8")
+        data_start = _aligned(len(SNAPSHOT_MAGIC) + 8 + len(header_bytes))
+
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary_path, "wb") as file:
+            file.write(SNAPSHOT_MAGIC)
+            file.write(len(header_bytes).to_bytes(8, "little"))
+            file.write(header_bytes)
+            for name, dtype in SNAPSHOT_ARRAYS:
+                file.seek(data_start + header["arrays"][name]["offset"])
+                file.write(numpy.ascontiguousarray(self._arrays[name], dtype=dtype).tobytes())
+            file.truncate(data_start + offset)
+        os.replace(temporary_path, path)
+        self.path = path
+
+    # memory-maps a snapshot file written by save. the arrays are read-only views of the mapping
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            if file.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError("{} is not a vulnerability snapshot".format(path))
+            header_length = int.from_bytes(file.read(8), "little")
+            header = json.loads(file.read(header_length).decode("utf-8"))
+            if header.get("version") != SNAPSHOT_VERSION:
+                raise ValueError("{} is snapshot version {}, expected {}".format(path, header.get("version"), SNAPSHOT_VERSION))
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        data_start = _aligned(len(SNAPSHOT_MAGIC) + 8 + header_length)
+        arrays = {name: numpy.frombuffer(mapping, dtype=layout["dtype"], count=layout["length"], offset=data_start + layout["offset"])
+                for name, layout in header.pop("arrays").items()}
+        return cls(arrays, header, path)
+
+    # a snapshot loaded from (or saved to) a file is pickled as its path, so worker processes map the file themselves
+    def __reduce__(self):
+        if self.path is not None:
+            return (VulnerabilitySnapshot.load, (self.path,))
+        return (VulnerabilitySnapshot, (self._arrays, self.metadata))
+
+    @property
+    def watermark(self):
+        return self.metadata.get("watermark")
+
+    # same as Ceritas_Database.get_product_vulnerability_ids
+    def get_product_vulnerability_ids(self, product_id=None, by_product=False):
+        if product_id is None:
+            if by_product:
+                return {id: self._walk(self._nvd_of_core([id])) for id in self._core_ids.tolist()}
+            if len(self._core_nvd) == 0:
+                return -1
+            return self._walk(self._core_nvd)
+
+        if type(product_id) is not list: product_id = [ product_id ]
+        if by_product:
+            return {id: self._walk(self._nvd_of_core([id])) for id in product_id}
+        if len(product_id) == 0:
+            return -1
+        nvd = self._nvd_of_core(product_id)
+        if len(nvd) == 0:
+            return -1
+        return self._walk(nvd)
+
+    # same as Ceritas_Database.get_nvd_product_vulnerability_ids
+    def get_nvd_product_vulnerability_ids(self, nvd_product_id, by_product=False):
+        if type(nvd_product_id) is not list: nvd_product_id = [ nvd_product_id ]
+        if by_product:
+            return {id: self._walk(_positions(self._nvd_ids, [id])) for id in nvd_product_id}
+        return self._walk(_positions(self._nvd_ids, nvd_product_id))
+
+    # same as Ceritas_Database.get_all_severities_for_product: the severity of each distinct CVE of the product(s),
+    # as floats (None where the severity is null), ordered by CVE id. products without CVEs give an empty list
+    def get_all_severities_for_product(self, product_id):
+        severities = self._severities(self._nvd_of_core(product_id if type(product_id) is list else [ product_id ]))
+        return [None if numpy.isnan(severity) else severity for severity in severities.tolist()]
+
+    # same ratings as Ceritas_Database.rate_core_product_bulk. products linked to several nvd_products are rated on the lowest nvd_product id
+    def rate_core_product(self, core_product_ids):
+        if type(core_product_ids) is not list: core_product_ids = [ core_product_ids ]
+        positions, found = _lookup(self._core_ids, core_product_ids)
+        sums = self._weighted_severity_sums(self._core_nvd[self._core_offsets[positions[found]]])
+        ratings = [250] * len(core_product_ids)
+        for index, severity_sum in zip(numpy.flatnonzero(found).tolist(), sums.tolist()):
+            ratings[index] = rating_from_severity_sum(severity_sum)
+        return ratings
+
+    # same ratings as Ceritas_Database.rate_nvd_product_bulk
+    def rate_nvd_product(self, nvd_product_ids):
+        if type(nvd_product_ids) is not list: nvd_product_ids = [ nvd_product_ids ]
+        positions, found = _lookup(self._nvd_ids, nvd_product_ids)
+        sums = numpy.zeros(len(nvd_product_ids))
+        sums[found] = self._weighted_severity_sums(positions[found])
+        return [rating_from_severity_sum(severity_sum) for severity_sum in sums.tolist()]
+
+    # indexes into nvd_ids of the nvd_products of the given core product ids
+    def _nvd_of_core(self, core_product_ids):
+        return _gather(self._core_offsets, self._core_nvd, _positions(self._core_ids, core_product_ids))
+
+    # nvd_cve_id of every nvd_configuration_cve row of every distinct configuration reached from the nvd_products at indexes nvd
+    def _walk(self, nvd):
+        configurations = numpy.unique(_gather(self._nvd_offsets, self._nvd_configurations, nvd))
+        rows = _positions(self._configuration_ids, configurations)
+        return _gather(self._configuration_offsets, self._configuration_cves, rows).tolist()
+
+    # severities of the distinct CVEs reached from the nvd_products at indexes nvd, in CVE id order
+    def _severities(self, nvd):
+        return self._cve_severities[_positions(self._cve_ids, numpy.unique(self._walk(nvd)))]
+
+    # weighted severity sum of each of the nvd_products at indexes nvd, counting each distinct CVE once per product.
+    # the whole list is walked at once: every (product, child) pair is carried along with the product's position in nvd
+    def _weighted_severity_sums(self, nvd):
+        products, configurations = _gather_pairs(self._nvd_offsets, self._nvd_configurations, nvd)
+        rows, found = _lookup(self._configuration_ids, configurations)
+        products, cves = _gather_pairs(self._configuration_offsets, self._configuration_cves, rows[found], products[found])
+        if len(cves) > 0:
+            products, cves = numpy.unique(numpy.stack((products, cves)), axis=1)
+        rows, found = _lookup(self._cve_ids, cves)
+        severities = self._cve_severities[rows[found]]
+        weighted = numpy.where(severities >= 9.0, severities * CRITICAL_WEIGHT,
+                numpy.where(severities >= 7.0, severities * HIGH_WEIGHT, severities * LOW_WEIGHT))
+        return numpy.bincount(products[found], weights=numpy.nan_to_num(weighted), minlength=len(nvd))
+
+# runs sql on a server-side cursor of connection and returns its columns as numpy arrays of the given dtypes.
+# each batch of rows is turned into arrays as it arrives, so at most itersize rows are held as python objects
+def _read_columns(db, connection, sql, dtypes, itersize):
+    batches = [[numpy.empty(0, dtype=dtype)] for dtype in dtypes]
+    with connection.cursor(name="ceritas_snapshot_{}".format(next(_snapshot_cursor_names))) as cursor:
+        cursor.itersize = itersize
+        db._execute(cursor, sql, prepare=False)
+        while True:
+            rows = cursor.fetchmany(itersize)
+            if not rows:
+                break
+            for column, values, dtype in zip(batches, zip(*rows), dtypes):
+                column.append(numpy.array(values, dtype=dtype))
+    return tuple(numpy.concatenate(column) for column in batches)
+
+# keys: sorted array of parent ids, one per child. returns (ids, offsets): the parent ids (the distinct keys, or ids if given)
+# and the offset of each one's first child, with the total number of children at the end
+def _csr(keys, ids=None):
+    if ids is None:
+        ids = numpy.unique(keys)
+    offsets = numpy.empty(len(ids) + 1, dtype="<i8")
+    offsets[:-1] = numpy.searchsorted(keys, ids, side="left")
+    offsets[-1] = len(keys)
+    return ids, offsets
+
+# looks values up in the sorted array ids. returns (positions, found): where each value is, and whether it is there at all
+def _lookup(ids, values):
+    values = numpy.asarray(values, dtype=ids.dtype)
+    positions = numpy.searchsorted(ids, values)
+    found = positions < len(ids)
+    found[found] = ids[positions[found]] == values[found]
+    return positions, found
+
+# positions in the sorted array ids of each of values that is present in it
+def _positions(ids, values):
+    positions, found = _lookup(ids, values)
+    return positions[found]
+
+# concatenates the children of each of rows, in order
+def _gather(offsets, children, rows):
+    return _gather_pairs(offsets, children, rows)[1]
+
+# same as _gather, and also returns the label of the row each child came from: its position in rows, or labels[position] if given
+def _gather_pairs(offsets, children, rows, labels=None):
+    rows = numpy.asarray(rows, dtype="<i8")
+    if labels is None:
+        labels = numpy.arange(len(rows))
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return labels[:0], children[:0]
+    shifts = numpy.repeat(starts - numpy.concatenate(([0], numpy.cumsum(lengths)[:-1])), lengths)
+    return numpy.repeat(labels, lengths), children[shifts + numpy.arange(total)]
+
+def _aligned(offset):
+    return (offset + SNAPSHOT_ALIGNMENT - 1) // SNAPSHOT_ALIGNMENT * SNAPSHOT_ALIGNMENT
@@ -12,9 +12,9 @@ veritech_product_df = pd.DataFrame(products)
 veritech_product_df.to_csv("test_files/get_one_customer_products.csv")
 
 # here, we get all rows from table "nvd_products", but only the columns "cpe_short_product" and "id"
-nvd_products = db_instance.get_all_from_table("nvd_products", ["cpe_short_product", "id"])
-
-nvd_product_df = pd.DataFrame(nvd_products)
+# format="dataframe" builds the dataframe straight from the query result, without making a dictionary per row first.
+# the get_* readers also accept format="columns", "numpy" or "arrow"
+nvd_product_df = db_instance.get_all_from_table("nvd_products", ["cpe_short_product", "id"], format="dataframe")
 nvd_product_df.to_csv("test_files/get_all_from_table.csv")
 
 # here we are getting all "vulnerable products", meaning, products linked to nvd_products. all columns are pulled
@@ -40,6 +40,13 @@ cve_strings = cve_df.cve.values.tolist()
 cve_df2 = pd.DataFrame(db_instance.get_cve_info_by_name(cve_strings, ['cve', 'severity', 'date_modified']))
 cve_df2.to_csv("test_files/get_cve_info_by_name.csv")
 
-# lastly, we are getting all severities for vulnerable products. severities come back as a list of numbers for each product
-vulnerable_product_df['severites'] = vulnerable_product_df['id'].apply(lambda id : db_instance.get_all_severities_for_product(id))
-vulnerable_product_df.to_csv("test_files/get_all_severites.csv")
\ No newline at end of file
+# lastly, we are getting all severities for vulnerable products. severities come back as a list of numbers for each product, in the same order as the ids,
+# all with one query instead of one get_all_severities_for_product call per row
+vulnerable_product_df['severites'] = db_instance.get_severities_for_products(vulnerable_product_df.id.values.tolist())
+vulnerable_product_df.to_csv("test_files/get_all_severites.csv")
+
+# aggregates=True also returns the number of CVEs, the highest severity and the weighted severity sums by band, one row per product.
+# the rows are in the same order as the ids, so with format="dataframe" they line up with the product dataframe
+severity_df = db_instance.get_severities_for_products(vulnerable_product_df.id.values.tolist(), aggregates=True, format="dataframe")
+vulnerable_product_df = pd.concat([vulnerable_product_df, severity_df.drop(columns=["core_product_id", "severities"])], axis=1)
+vulnerable_product_df.to_csv("test_files/get_severities_for_products.csv")
\ No newline at end of file
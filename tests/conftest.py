@@ -0,0 +1,71 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# ceritas_data_layer reads Reporting/rating_config.ini from the working directory when it is imported, and so do the
+# rating worker processes. unless the tests are run from a directory that has one, they run from a scratch directory
+# holding the repo's configs/rating_config.ini
+if not os.path.exists(os.path.join("Reporting", "rating_config.ini")):
+    _scratch = tempfile.mkdtemp(prefix="ceritas_tests_")
+    os.makedirs(os.path.join(_scratch, "Reporting"))
+    shutil.copy(os.path.join(ROOT, "configs", "rating_config.ini"), os.path.join(_scratch, "Reporting", "rating_config.ini"))
+    os.chdir(_scratch)
+
+import benchmark
+import ceritas_data_layer
+
+# number of CVEs in the dataset the database tests run against, see benchmark.generate
+TEST_SCALE = 2000
+
+# credentials of a postgres database the tests may write to, from CERITAS_TEST_DATABASE, CERITAS_TEST_USER,
+# CERITAS_TEST_PASSWORD and CERITAS_TEST_HOST. tests that need a database are skipped when CERITAS_TEST_DATABASE is not set.
+# the dataset is generated in benchmark.SCHEMA, which is dropped afterwards
+@pytest.fixture(scope="session")
+def connect_args():
+    if not os.environ.get("CERITAS_TEST_DATABASE"):
+        pytest.skip("CERITAS_TEST_DATABASE is not set")
+    args = {'database': os.environ["CERITAS_TEST_DATABASE"],
+            'user': os.environ.get("CERITAS_TEST_USER", "postgres"),
+            'password': os.environ.get("CERITAS_TEST_PASSWORD", ""),
+            'host': os.environ.get("CERITAS_TEST_HOST", "localhost")}
+
+    # every connection the layer opens (streams, snapshots, worker processes) has to read the test schema
+    pgoptions = os.environ.get("PGOPTIONS")
+    os.environ["PGOPTIONS"] = ((pgoptions or "") + " -c search_path={}".format(benchmark.SCHEMA)).strip()
+    db = ceritas_data_layer.Ceritas_Database(**args)
+    try:
+        benchmark.generate(db.connection, TEST_SCALE)
+        yield args
+    finally:
+        db.connection.rollback()
+        db.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(benchmark.SCHEMA))
+        db.close()
+        if pgoptions is None:
+            del os.environ["PGOPTIONS"]
+        else:
+            os.environ["PGOPTIONS"] = pgoptions
+
+@pytest.fixture
+def database(connect_args):
+    db = ceritas_data_layer.Ceritas_Database(**connect_args)
+    yield db
+    db.close(commit=False)
+
+@pytest.fixture
+def pooled_database(connect_args):
+    db = ceritas_data_layer.Ceritas_Database.from_pool(1, 4, **connect_args)
+    yield db
+    db.close()
+
+# ids of every core product and nvd product in the test dataset, plus one that doesn't exist
+@pytest.fixture
+def product_ids(database):
+    core_product_ids = [row[0] for row in database.query("SELECT id FROM core_products ORDER BY id;")]
+    nvd_product_ids = [row[0] for row in database.query("SELECT id FROM nvd_products ORDER BY id;")]
+    return core_product_ids + [-5], nvd_product_ids + [-5]
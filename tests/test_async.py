@@ -0,0 +1,160 @@
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import pytest
+
+pytest.importorskip("psycopg_pool")
+
+from psycopg.rows import dict_row
+
+from ceritas_data_layer import WEIGHT_PARAMS, WEIGHTED_SEVERITY_SUMS_SQL, rating_from_severity_sum
+from ceritas_data_layer_async import AsyncCeritasDatabase
+
+
+class StandInCursor:
+    def __init__(self, pool, row_factory):
+        self.pool = pool
+        self.row_factory = row_factory
+        self.description = None
+        self.rows = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    async def execute(self, sql, params=None):
+        self.pool.statements.append((sql, params))
+        # yield to the event loop, so concurrent calls overlap like they would on a socket
+        await asyncio.sleep(0)
+        names, self.rows = self.pool.respond(sql, params)
+        self.description = [(name,) for name in names]
+
+    async def fetchall(self):
+        if self.row_factory is dict_row:
+            return [dict(zip([description[0] for description in self.description], row)) for row in self.rows]
+        return list(self.rows)
+
+    async def fetchone(self):
+        rows = await self.fetchall()
+        return rows[0] if len(rows) > 0 else None
+
+class StandInConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def cursor(self, row_factory=None):
+        return StandInCursor(self.pool, row_factory)
+
+# stands in for psycopg_pool.AsyncConnectionPool. respond(sql, params) returns the column names and rows of a statement
+class StandInPool:
+    def __init__(self, respond):
+        self.respond = respond
+        self.statements = []
+        self.active = 0
+        self.max_active = 0
+        self.closed = False
+
+    @asynccontextmanager
+    async def connection(self):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            yield StandInConnection(self)
+        finally:
+            self.active -= 1
+
+    async def close(self):
+        self.closed = True
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_product_rating_keeps_the_requested_order():
+    pool = StandInPool(lambda sql, params: (["id", "value"], [(3, 150), (1, 200)]))
+    db = AsyncCeritasDatabase(pool)
+    assert run(db.get_product_rating([1, 2, 3])) == [200, None, 150]
+    assert run(db.get_product_rating([1, 2], as_dict=True)) == {1: 200, 2: None}
+    assert run(db.get_product_rating([])) == []
+    assert pool.statements[0][1] == ([1, 2, 3],)
+    assert len(pool.statements) == 2
+
+def test_vulnerability_ids_of_unknown_products():
+    pool = StandInPool(lambda sql, params: (["exists", "array"], [(False, [])]))
+    db = AsyncCeritasDatabase(pool)
+    assert run(db.get_product_vulnerability_ids(7)) == -1
+    assert run(db.get_product_vulnerability_ids([])) == -1
+    assert run(db.get_nvd_product_vulnerability_ids(7)) == []
+    assert run(db.get_all_severities_for_product(7)) == []
+    assert len(pool.statements) == 3
+
+def test_severities_for_a_product():
+    def respond(sql, params):
+        if "EXISTS" in sql:
+            return ["exists", "array"], [(True, [10, 11])]
+        return ["severity"], [(9.8,), (5.0,)]
+    pool = StandInPool(respond)
+    db = AsyncCeritasDatabase(pool)
+    assert run(db.get_all_severities_for_product(1)) == [9.8, 5.0]
+    assert pool.statements[1][1] == ([10, 11],)
+
+def test_rate_core_product():
+    pool = StandInPool(lambda sql, params: (["key", "sum"], [(1, 40.0), (2, 0.0)]))
+    db = AsyncCeritasDatabase(pool)
+    assert run(db.rate_core_product([1, 2, 3])) == [rating_from_severity_sum(40.0), rating_from_severity_sum(0.0), 250]
+    sql, params = pool.statements[0]
+    assert sql == WEIGHTED_SEVERITY_SUMS_SQL.format(key="core_product_id", ids="core_product_id = ANY(%s)")
+    assert params == ([1, 2, 3],) + WEIGHT_PARAMS
+    assert run(db.rate_core_product([])) == []
+    assert len(pool.statements) == 1
+
+def test_id_lists_are_cleaned_like_the_blocking_client():
+    pool = StandInPool(lambda sql, params: (["id", "value"], [(1, 200)]))
+    db = AsyncCeritasDatabase(pool)
+    assert run(db.get_product_rating([1.0, None, 1])) == [200, None, 200]
+    assert pool.statements[0][1] == ([1],)
+
+def test_customers_products_are_grouped():
+    pool = StandInPool(lambda sql, params: (["name", "id", "name"], [("acme", 1, "a"), ("acme", 2, "b"), ("globex", 3, "c")]))
+    db = AsyncCeritasDatabase(pool)
+    products = run(db.get_customers_products(["acme", "globex", "initech"], ["id", "name"]))
+    assert products == {'acme': [{'id': 1, 'name': "a"}, {'id': 2, 'name': "b"}],
+                        'globex': [{'id': 3, 'name': "c"}],
+                        'initech': []}
+    assert "p.id, p.name" in pool.statements[0][0]
+
+def test_gathered_calls_borrow_their_own_connections():
+    pool = StandInPool(lambda sql, params: (["id"], [(1,)]))
+
+    async def lookups():
+        async with AsyncCeritasDatabase(pool) as db:
+            return await asyncio.gather(db.get_product_info_by_id([1]), db.get_vulnerable_products(), db.get_cve_info_by_id(1))
+
+    assert run(lookups()) == [[{'id': 1}]] * 3
+    assert pool.max_active == 3
+    assert pool.active == 0
+    assert pool.closed
+
+def test_matches_database(database, connect_args, product_ids):
+    core_product_ids, nvd_product_ids = product_ids
+
+    async def compare():
+        async with await AsyncCeritasDatabase.connect(**connect_args) as db:
+            ratings, nvd_ratings, vulnerabilities = await asyncio.gather(
+                    db.rate_core_product(core_product_ids),
+                    db.rate_nvd_product(nvd_product_ids),
+                    db.get_product_vulnerability_ids(core_product_ids[:20], by_product=True))
+            assert ratings == database.rate_core_product(core_product_ids)
+            assert nvd_ratings == database.rate_nvd_product_bulk(nvd_product_ids)
+            expected = database.get_product_vulnerability_ids(core_product_ids[:20], by_product=True)
+            assert {id: Counter(cves) for id, cves in vulnerabilities.items()} == {id: Counter(cves) for id, cves in expected.items()}
+            assert await db.get_product_rating(core_product_ids) == database.get_product_rating(core_product_ids)
+            for id in core_product_ids[:20] + [-5]:
+                severities = await db.get_all_severities_for_product(id)
+                assert Counter(severities) == Counter(database.get_all_severities_for_product(id))
+            uuids = [str(row['uuid']) for row in database.get_product_info_by_id(core_product_ids[:5], "uuid")]
+            assert len(await db.get_product_info_by_uuid(uuids)) == 5
+
+    run(compare())
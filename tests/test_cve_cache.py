@@ -0,0 +1,66 @@
+import ceritas_data_layer
+from ceritas_data_layer import CveCache
+
+
+def cve(id):
+    return {'id': id, 'cve': "CVE-2024-{}".format(id), 'severity': 5.0}
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def test_get_counts_hits_and_misses():
+    cache = CveCache()
+    assert cache.get(1) is None
+    cache.put(cve(1))
+    assert cache.get(1) == cve(1)
+    assert cache.get_by_name("CVE-2024-1") == cve(1)
+    assert cache.get_by_name("CVE-2024-2") is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+def test_least_recently_used_rows_are_evicted():
+    cache = CveCache(maxsize=2)
+    cache.put(cve(1))
+    cache.put(cve(2))
+    cache.get(1)
+    cache.put(cve(3))
+    assert len(cache) == 2
+    assert cache.get(2) is None
+    assert cache.get_by_name("CVE-2024-2") is None
+    assert cache.get(1) == cve(1)
+    assert cache.get(3) == cve(3)
+
+def test_rows_expire_after_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ceritas_data_layer.time, "monotonic", clock)
+    cache = CveCache(ttl=60)
+    cache.put(cve(1))
+    clock.now += 59
+    assert cache.get(1) == cve(1)
+    clock.now += 2
+    assert cache.get(1) is None
+    assert cache.get_by_name("CVE-2024-1") is None
+    assert len(cache) == 0
+
+def test_put_replaces_a_row_and_its_name():
+    cache = CveCache()
+    cache.put(cve(1))
+    cache.put({'id': 1, 'cve': "CVE-2024-100", 'severity': 9.0})
+    assert cache.get_by_name("CVE-2024-1") is None
+    assert cache.get_by_name("CVE-2024-100")['severity'] == 9.0
+
+def test_invalidate():
+    cache = CveCache()
+    for id in range(1, 5):
+        cache.put(cve(id))
+    cache.invalidate(nvd_cve_id=1)
+    cache.invalidate(cve=["CVE-2024-2"])
+    assert cache.get(1) is None
+    assert cache.get(2) is None
+    assert cache.get(3) == cve(3)
+    cache.invalidate()
+    assert len(cache) == 0
+    assert cache.get_by_name("CVE-2024-4") is None
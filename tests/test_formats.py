@@ -0,0 +1,44 @@
+from decimal import Decimal
+
+import pytest
+
+from ceritas_data_layer import to_format
+
+NAMES = ["id", "severity", "cves"]
+ROWS = [(1, Decimal("9.8"), [3, 4]), (2, None, [])]
+
+
+def test_rows():
+    assert to_format(NAMES, ROWS, None) == [{'id': 1, 'severity': Decimal("9.8"), 'cves': [3, 4]},
+                                            {'id': 2, 'severity': None, 'cves': []}]
+    assert to_format(NAMES, ROWS, "rows") == to_format(NAMES, ROWS, None)
+
+def test_columns():
+    assert to_format(NAMES, ROWS, "columns") == {'id': [1, 2], 'severity': [Decimal("9.8"), None], 'cves': [[3, 4], []]}
+    assert to_format(NAMES, [], "columns") == {'id': [], 'severity': [], 'cves': []}
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        to_format(NAMES, ROWS, "csv")
+
+def test_numpy():
+    pytest.importorskip("numpy")
+    result = to_format(NAMES, ROWS, "numpy")
+    assert result['id'].tolist() == [1, 2]
+    assert result['severity'].tolist() == [9.8, None]
+    assert result['cves'].dtype == object
+    assert result['cves'].tolist() == [[3, 4], []]
+
+def test_dataframe():
+    pytest.importorskip("pandas")
+    frame = to_format(NAMES, ROWS, "dataframe")
+    assert list(frame.columns) == NAMES
+    assert frame['severity'].dtype.kind == "f"
+    assert frame['cves'].tolist() == [[3, 4], []]
+    assert list(to_format(NAMES, [], "dataframe").columns) == NAMES
+
+def test_arrow():
+    pytest.importorskip("pyarrow")
+    table = to_format(NAMES, ROWS, "arrow")
+    assert table.column_names == NAMES
+    assert table.column("severity").to_pylist() == [9.8, None]
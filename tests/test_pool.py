@@ -0,0 +1,57 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import pytest
+from psycopg2.pool import PoolError
+
+from ceritas_data_layer import Ceritas_Database
+
+
+@pytest.fixture
+def small_pool(connect_args):
+    db = Ceritas_Database.from_pool(1, 2, timeout=10, **connect_args)
+    yield db
+    db.close()
+
+def test_calls_past_maxconn_wait_for_a_connection(small_pool):
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda i: small_pool.query("SELECT %s FROM pg_sleep(0.05);", (i,)), range(16)))
+    assert results == [[(i,)] for i in range(16)]
+
+def test_waiting_times_out(connect_args):
+    db = Ceritas_Database.from_pool(1, 1, timeout=0.1, **connect_args)
+    errors = []
+    def query():
+        try:
+            db.query("SELECT 1;")
+        except PoolError as error:
+            errors.append(error)
+    try:
+        with db.borrow():
+            thread = threading.Thread(target=query)
+            thread.start()
+            thread.join()
+        assert len(errors) == 1
+        assert db.query("SELECT 1;") == [(1,)]
+    finally:
+        db.close()
+
+def test_open_streams_hold_a_connection(small_pool):
+    stream = small_pool.iter_all_from_table("core_products", "id")
+    next(stream)
+    assert small_pool.get_count_from_table("core_products") > 0
+    stream.close()
+
+def test_dropped_connections_are_replaced(connect_args):
+    db = Ceritas_Database.from_pool(1, 1, ping_after=0, **connect_args)
+    killer = psycopg2.connect(**connect_args)
+    killer.autocommit = True
+    try:
+        pid = db.query("SELECT pg_backend_pid();")[0][0]
+        with killer.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s);", (pid,))
+        assert db.query("SELECT pg_backend_pid();")[0][0] != pid
+    finally:
+        killer.close()
+        db.close()
@@ -0,0 +1,140 @@
+from collections import Counter
+from datetime import timedelta
+
+import pytest
+
+from ceritas_data_layer import (CRITICAL_WEIGHT, HIGH_WEIGHT, LOW_WEIGHT, MAX_SEVERITY, MINIMUM_SEVERITY, WATERMARK_LAG,
+        RatingWriteError, rating_from_severity_sum, weighted_severity)
+
+
+def severity_sum_for(product_severity):
+    return MINIMUM_SEVERITY + product_severity / 10 * (MAX_SEVERITY - MINIMUM_SEVERITY)
+
+def test_weighted_severity_bands():
+    assert weighted_severity(6.9) == 6.9 * LOW_WEIGHT
+    assert weighted_severity(7.0) == 7.0 * HIGH_WEIGHT
+    assert weighted_severity(8.9) == 8.9 * HIGH_WEIGHT
+    assert weighted_severity(9.0) == 9.0 * CRITICAL_WEIGHT
+    assert weighted_severity("9.8") == 9.8 * CRITICAL_WEIGHT
+
+def test_rating_from_severity_sum():
+    assert rating_from_severity_sum(MINIMUM_SEVERITY) == 250
+    assert rating_from_severity_sum(severity_sum_for(2.0)) == 200
+    assert rating_from_severity_sum(severity_sum_for(5.0)) == 150
+    assert rating_from_severity_sum(severity_sum_for(9.0)) == 100
+    assert rating_from_severity_sum(MAX_SEVERITY * 10) == 100
+
+def test_bulk_rating_matches_serial(database, product_ids):
+    core_product_ids, nvd_product_ids = product_ids
+    serial = database.rate_core_product(core_product_ids)
+    assert database.rate_core_product_bulk(core_product_ids) == serial
+    linked = [id for id in nvd_product_ids if id > 0]
+    assert database.rate_nvd_product_bulk(linked) == database.rate_nvd_product(linked)
+
+def test_pooled_bulk_rating_matches_serial(database, pooled_database, product_ids):
+    core_product_ids, nvd_product_ids = product_ids
+    assert pooled_database.rate_core_product_bulk(core_product_ids) == database.rate_core_product(core_product_ids)
+
+def test_parallel_rating_matches_serial(database, product_ids):
+    core_product_ids, nvd_product_ids = product_ids
+    serial = database.rate_core_product(core_product_ids)
+    assert database.rate_core_product_parallel(core_product_ids, workers=2, chunk_size=50) == serial
+    assert database.rate_core_product_parallel(core_product_ids, workers=2, chunk_size=70, bulk=True) == serial
+
+def test_batched_severities_match_per_product(database, product_ids):
+    core_product_ids, nvd_product_ids = product_ids
+    sample = core_product_ids[:40] + [None]
+    batched = database.get_severities_for_products(sample)
+    for id, severities in zip(sample[:-1], batched):
+        cve_ids = database.get_product_vulnerability_ids(id)
+        expected = [] if cve_ids in (-1, []) else database.get_all_severities_for_product(id)
+        assert Counter(severities) == Counter(expected)
+    assert batched[-1] == []
+
+    rows = database.get_severities_for_products(sample, aggregates=True)
+    for row, severities in zip(rows, batched):
+        weighted = [weighted_severity(severity) for severity in severities]
+        assert row['count'] == len(severities)
+        assert row['max_severity'] == (max(severities) if len(severities) > 0 else None)
+        assert row['weighted_sum'] == pytest.approx(sum(weighted))
+
+def test_changed_products_are_rated(database):
+    ratings, watermark = database.rate_changed_core_products()
+    linked = database.query("SELECT DISTINCT core_product_id FROM nvd_products WHERE core_product_id IS NOT NULL;")
+    assert set(ratings) == {row[0] for row in linked}
+    again, next_watermark = database.rate_changed_core_products(watermark)
+    assert next_watermark == watermark
+    assert set(again) <= set(ratings)
+
+# products linked to a CVE, through any of their nvd products
+def products_of_cve(database, cve_id):
+    return {row[0] for row in database.query(
+        "SELECT np.core_product_id FROM nvd_configuration_cve cc "
+        "JOIN nvd_cpe_match_configuration mc ON mc.nvd_configuration_id = cc.nvd_configuration_id "
+        "JOIN nvd_cpe_matches m ON m.id = mc.nvd_cpe_match_id "
+        "JOIN nvd_products np ON np.id = m.nvd_product_id WHERE cc.nvd_cve_id = %s AND np.core_product_id IS NOT NULL;", (cve_id,))}
+
+@pytest.mark.parametrize("modified", [timedelta(hours=1), -WATERMARK_LAG / 2])
+def test_cves_modified_since_the_watermark_are_picked_up(database, modified):
+    ratings, watermark = database.rate_changed_core_products()
+    cve_id = database.query(
+        "SELECT cc.nvd_cve_id FROM nvd_configuration_cve cc "
+        "JOIN nvd_cpe_match_configuration mc ON mc.nvd_configuration_id = cc.nvd_configuration_id "
+        "JOIN nvd_cpe_matches m ON m.id = mc.nvd_cpe_match_id "
+        "JOIN nvd_products np ON np.id = m.nvd_product_id WHERE np.core_product_id IS NOT NULL ORDER BY cc.id LIMIT 1;")[0][0]
+    # a CVE modified after the watermark, or committed late by a sync, within the lag before it
+    database.execute("UPDATE nvd_cves SET date_modified = %s WHERE id = %s;", (watermark + modified, cve_id))
+    changed, next_watermark = database.rate_changed_core_products(watermark)
+    database.connection.rollback()
+    linked = products_of_cve(database, cve_id)
+    assert len(linked) > 0
+    assert linked <= set(changed)
+    assert next_watermark == max(watermark, watermark + modified)
+
+def test_ratings_can_be_written_while_streaming(database):
+    before = database.get_count_from_table("core_rating_history")
+    written = {}
+    for batch in database.iter_vulnerable_products(batches=True, itersize=25):
+        ids = [row['id'] for row in batch]
+        written.update(database.write_product_ratings(zip(ids, database.rate_core_product_bulk(ids)), batch_size=10, commit=False))
+    assert len(written) == len(database.get_vulnerable_products())
+    assert database.get_product_rating(list(written), column="id", as_dict=True) == written
+    database.connection.rollback()
+    assert database.get_count_from_table("core_rating_history") == before
+
+def test_slow_writes_are_not_explained(database):
+    before = database.get_count_from_table("core_rating_history")
+    instrumentation = database.enable_instrumentation(slow_query_seconds=0)
+    database.write_product_ratings({1: 100, 2: 150}, commit=False)
+    assert database.get_count_from_table("core_rating_history") == before + 2
+    database.get_product_info_by_id([1, 2])
+    plans = [query['plan'] for query in instrumentation.slow_queries]
+    assert plans[0] is None
+    assert plans[-1] is not None
+    database.connection.rollback()
+
+def test_failed_writes_report_the_committed_batches(database):
+    current = dict(database.query("SELECT id, current_rating_history_id FROM core_products WHERE id IN (1, 2);"))
+    last_history_id = database.query("SELECT max(id) FROM core_rating_history;")[0][0]
+    database.connection.rollback()
+    try:
+        with pytest.raises(RatingWriteError) as raised:
+            database.write_product_ratings({1: 100, 2: 150, 3: "not a rating"}, batch_size=2)
+        assert list(raised.value.history_ids) == [1, 2]
+        assert raised.value.unwritten == [(3, "not a rating")]
+        assert raised.value.__cause__ is not None
+        assert database.get_product_rating([1, 2], column="id", as_dict=True) == raised.value.history_ids
+    finally:
+        # put back the rows committed into the shared dataset
+        database.connection.rollback()
+        for id, history_id in current.items():
+            database.execute("UPDATE core_products SET current_rating_history_id = %s WHERE id = %s;", (history_id, id))
+        database.execute("DELETE FROM core_rating_history WHERE id > %s;", (last_history_id,))
+        database.connection.commit()
+
+def test_failed_writes_without_commit_report_nothing_committed(database):
+    with pytest.raises(RatingWriteError) as raised:
+        database.write_product_ratings({1: 100, 2: 150, 3: "not a rating"}, batch_size=2, commit=False)
+    database.connection.rollback()
+    assert raised.value.history_ids == {}
+    assert len(raised.value.unwritten) == 1
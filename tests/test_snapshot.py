@@ -0,0 +1,97 @@
+import pickle
+from collections import Counter
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from ceritas_data_layer import rating_from_severity_sum, weighted_severity
+from ceritas_snapshot import SNAPSHOT_ARRAYS, VulnerabilitySnapshot
+
+
+def columns(*rows, dtypes=("<i8", "<i8")):
+    if len(rows) == 0:
+        return tuple(numpy.empty(0, dtype=dtype) for dtype in dtypes)
+    return tuple(numpy.array(values, dtype=dtype) for values, dtype in zip(zip(*rows), dtypes))
+
+# core product 1 is linked to nvd products 10 and 11, core product 2 to 12, nvd product 13 to no core product.
+# configuration 102 has no CVEs, CVE 1002 has no severity and CVE 1005 is missing from nvd_cves
+@pytest.fixture
+def snapshot():
+    return VulnerabilitySnapshot.from_columns(
+        columns((10, 1), (11, 1), (12, 2), (13, -1)),
+        columns((10, 100), (10, 101), (11, 101), (12, 102), (13, 100)),
+        columns((100, 1000), (100, 1001), (101, 1001), (101, 1002), (101, 1005), (103, 1003)),
+        columns((1000, 9.5), (1001, 7.5), (1002, float("nan")), (1003, 3.0), dtypes=("<i8", "<f8")))
+
+def test_product_vulnerability_ids(snapshot):
+    assert Counter(snapshot.get_product_vulnerability_ids(1)) == Counter([1000, 1001, 1001, 1002, 1005])
+    assert snapshot.get_product_vulnerability_ids(2) == []
+    assert snapshot.get_product_vulnerability_ids(3) == -1
+    assert snapshot.get_product_vulnerability_ids([]) == -1
+    by_product = snapshot.get_product_vulnerability_ids([2, 3], by_product=True)
+    assert by_product == {2: [], 3: []}
+    assert set(snapshot.get_product_vulnerability_ids(by_product=True)) == {1, 2}
+
+def test_nvd_product_vulnerability_ids(snapshot):
+    assert sorted(snapshot.get_nvd_product_vulnerability_ids(13)) == [1000, 1001]
+    assert snapshot.get_nvd_product_vulnerability_ids([99]) == []
+    assert snapshot.get_nvd_product_vulnerability_ids([12, 99], by_product=True) == {12: [], 99: []}
+
+def test_severities(snapshot):
+    assert snapshot.get_all_severities_for_product(1) == [9.5, 7.5, None]
+    assert snapshot.get_all_severities_for_product(2) == []
+    assert snapshot.get_all_severities_for_product(3) == []
+
+def test_ratings(snapshot):
+    # core product 1 is rated on its lowest nvd product, 10, each distinct CVE once
+    assert snapshot.rate_core_product([1, 2, 3, 1.0]) == [
+        rating_from_severity_sum(weighted_severity(9.5) + weighted_severity(7.5)),
+        rating_from_severity_sum(0.0),
+        250,
+        rating_from_severity_sum(weighted_severity(9.5) + weighted_severity(7.5))]
+    assert snapshot.rate_nvd_product([11, 99]) == [rating_from_severity_sum(weighted_severity(7.5)), rating_from_severity_sum(0.0)]
+    assert snapshot.rate_core_product([]) == []
+
+def test_empty_snapshot():
+    empty = VulnerabilitySnapshot.from_columns(columns(), columns(), columns(), columns(dtypes=("<i8", "<f8")))
+    assert empty.get_product_vulnerability_ids() == -1
+    assert empty.rate_core_product([1]) == [250]
+
+def test_save_and_load(snapshot, tmp_path):
+    path = str(tmp_path / "vulnerabilities.snap")
+    snapshot.save(path)
+    loaded = VulnerabilitySnapshot.load(path)
+    assert loaded.path == path
+    assert loaded.watermark is None
+    for name, dtype in SNAPSHOT_ARRAYS:
+        assert numpy.array_equal(loaded._arrays[name], snapshot._arrays[name], equal_nan=True)
+    assert not loaded._arrays["cve_ids"].flags.writeable
+    assert loaded.rate_core_product([1, 2, 3]) == snapshot.rate_core_product([1, 2, 3])
+
+def test_pickles_as_its_path(snapshot, tmp_path):
+    path = str(tmp_path / "vulnerabilities.snap")
+    snapshot.save(path)
+    data = pickle.dumps(VulnerabilitySnapshot.load(path))
+    assert len(data) < 200
+    assert pickle.loads(data).get_all_severities_for_product(1) == [9.5, 7.5, None]
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / "other.snap"
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(ValueError):
+        VulnerabilitySnapshot.load(str(path))
+
+def test_matches_database(database, product_ids, tmp_path):
+    core_product_ids, nvd_product_ids = product_ids
+    path = str(tmp_path / "vulnerabilities.snap")
+    VulnerabilitySnapshot.build(database).save(path)
+    snapshot = VulnerabilitySnapshot.load(path)
+
+    assert snapshot.rate_core_product(core_product_ids) == database.rate_core_product(core_product_ids)
+    assert snapshot.rate_nvd_product(nvd_product_ids) == database.rate_nvd_product_bulk(nvd_product_ids)
+    expected = database.get_product_vulnerability_ids(core_product_ids, by_product=True)
+    found = snapshot.get_product_vulnerability_ids(core_product_ids, by_product=True)
+    assert {id: Counter(cves) for id, cves in found.items()} == {id: Counter(cves) for id, cves in expected.items()}
+    for id, severities in zip(core_product_ids, database.get_severities_for_products(core_product_ids)):
+        assert snapshot.get_all_severities_for_product(id) == [float(severity) for severity in severities]
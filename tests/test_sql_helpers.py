@@ -0,0 +1,260 @@
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+from psycopg2.extras import RealDictCursor
+
+import ceritas_data_layer
+from ceritas_data_layer import (Ceritas_Database, PreparedStatementCache, _array_literal, _copy_text, _filter_ids, _numbered_placeholders,
+        _statement_template, rating_from_severity_sum)
+
+
+class RecordingCursor:
+    def __init__(self, connection, dicts=False):
+        self.connection = connection
+        self.dicts = dicts
+        self.description = None
+        self.rowcount = -1
+        self.query = None
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def execute(self, sql, params=None):
+        self.connection.log.append(sql)
+        self.query = sql.encode()
+        if not self.connection.autocommit:
+            self.connection.info.transaction_status = TRANSACTION_STATUS_INTRANS
+        names, self.rows = self.connection.respond(sql, params)
+        self.description = [(name,) for name in names]
+        self.rowcount = len(self.rows)
+
+    def copy_expert(self, sql, file):
+        self.connection.log.append((sql, file.read()))
+
+    def fetchall(self):
+        if self.dicts:
+            return [dict(zip([description[0] for description in self.description], row)) for row in self.rows]
+        return list(self.rows)
+
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if len(rows) > 0 else None
+
+class RecordingConnection:
+    closed = False
+    autocommit = False
+
+    def __init__(self):
+        self.log = []
+        self.info = SimpleNamespace(backend_pid=1, transaction_status=TRANSACTION_STATUS_IDLE)
+
+    def rollback(self):
+        self.log.append("ROLLBACK")
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+    # returns the column names and rows of a statement. override to script results
+    def respond(self, sql, params):
+        return [], []
+
+    def cursor(self, **kwargs):
+        return RecordingCursor(self, kwargs.get('cursor_factory') is RealDictCursor)
+
+# a Ceritas_Database whose connection only records the statements it is sent
+@pytest.fixture
+def recording_database():
+    db = Ceritas_Database.__new__(Ceritas_Database)
+    db._init_state(None, RecordingConnection(), {})
+    return db
+
+@pytest.fixture
+def small_limits(monkeypatch):
+    monkeypatch.setattr(ceritas_data_layer, "ID_ARRAY_LIMIT", 3)
+    monkeypatch.setattr(ceritas_data_layer, "ID_BATCH_LIMIT", 6)
+
+def test_array_literal_escapes_values():
+    assert _array_literal([1, 2]) == '{"1","2"}'
+    assert _array_literal(['a"b', 'c\\d', 'e,f']) == '{"a\\"b","c\\\\d","e,f"}'
+
+def test_copy_text_escapes_values():
+    assert _copy_text([1, "a\tb", "c\nd", "e\\f"]) == "1\na\\tb\nc\\nd\ne\\\\f\n"
+
+def test_filter_ids_drops_missing_and_normalizes_floats():
+    assert _filter_ids([3, 1.0, None, float("nan"), 3, 2.5, 1, "x"]) == [3, 1, "x"]
+    assert type(_filter_ids([4.0])[0]) is int
+    assert _filter_ids([None]) == []
+
+def test_empty_id_list_matches_nothing(recording_database):
+    assert list(recording_database._id_filters("core_products", "id", [None])) == [("false", ())]
+
+def test_short_id_list_is_one_array(recording_database, small_limits):
+    filters = list(recording_database._id_filters("core_products", "id", [1, 2, 2.0, 3], alias="p"))
+    assert filters == [("p.id = ANY(%s)", ('{"1","2","3"}',))]
+    assert recording_database.connection.log == []
+
+def test_longer_id_list_is_batched_when_split(recording_database, small_limits):
+    filters = list(recording_database._id_filters("core_products", "id", [1, 2, 3, 4, 5], split=True))
+    assert filters == [("id = ANY(%s)", ('{"1","2","3"}',)), ("id = ANY(%s)", ('{"4","5"}',))]
+    assert recording_database.connection.log == []
+
+@pytest.mark.parametrize("ids, split", [([1, 2, 3, 4], False), (list(range(1, 8)), True)])
+def test_long_id_list_uses_a_temporary_table(recording_database, small_limits, ids, split):
+    log = recording_database.connection.log
+    filters = recording_database._id_filters("nvd_products", "core_product_id", ids, split=split)
+    where_sql, params = next(filters)
+    assert where_sql.startswith("core_product_id IN (SELECT id FROM ceritas_ids_")
+    assert params == ()
+    assert log[0].startswith("CREATE TEMP TABLE ceritas_ids_")
+    assert log[1][0].startswith("COPY ceritas_ids_")
+    assert log[1][1] == "".join("{}\n".format(id) for id in ids)
+    assert log[2].startswith("ANALYZE ceritas_ids_")
+    assert len(log) == 3
+
+    assert list(filters) == []
+    assert log[3].startswith("DROP TABLE IF EXISTS ceritas_ids_")
+
+def test_empty_cve_list_returns_no_rows(recording_database):
+    assert recording_database.get_cve_info_by_id([]) == []
+    assert recording_database.get_cve_info_by_id([], format="columns") == {}
+    assert recording_database.connection.log == ["SELECT * FROM nvd_cves WHERE false;"] * 2
+
+# core product 1 is linked to nvd product 5, which has no CVEs
+def test_products_without_cves_are_rated(recording_database):
+    def respond(sql, params):
+        if sql.startswith("SELECT id FROM nvd_products WHERE core_product_id = %s"):
+            return ["id"], [(5,)]
+        if "EXISTS" in sql:
+            return ["exists", "array"], [(True, [])]
+        return ["severity"], []
+    recording_database.connection.respond = respond
+    assert recording_database.rate_nvd_product(5) == [rating_from_severity_sum(0.0)]
+    assert recording_database.rate_core_product(1) == [rating_from_severity_sum(0.0)]
+    assert recording_database.get_all_severities_for_product(1) == []
+
+def test_numbered_placeholders():
+    assert _numbered_placeholders("SELECT * FROM t WHERE a = %s AND b = ANY(%s);") == "SELECT * FROM t WHERE a = $1 AND b = ANY($2);"
+    assert _numbered_placeholders("SELECT '100%%' WHERE a = %s;") == "SELECT '100%' WHERE a = $1;"
+    assert _numbered_placeholders("SELECT 1;") == "SELECT 1;"
+
+# runs sql through cache on a new cursor of connection, in a transaction that already ran a statement unless idle
+def run_prepared(cache, connection, sql, params=(), idle=False):
+    connection.info.transaction_status = TRANSACTION_STATUS_IDLE if idle else TRANSACTION_STATUS_INTRANS
+    cursor = connection.cursor()
+    cache.execute(cursor, sql, params)
+    return cursor
+
+def test_statements_are_prepared_past_the_threshold():
+    connection = RecordingConnection()
+    cache = PreparedStatementCache(threshold=2)
+    run_prepared(cache, connection, "SELECT %s;", (1,), idle=True)
+    run_prepared(cache, connection, "SELECT %s;", (2,))
+    run_prepared(cache, connection, "SELECT %s;", (3,))
+    assert connection.log == ["SELECT %s;",
+                              "PREPARE ceritas_statement_0 AS SELECT $1;", "EXECUTE ceritas_statement_0 (%s);",
+                              "EXECUTE ceritas_statement_0 (%s);"]
+
+def test_least_recently_used_statements_are_deallocated_in_the_next_transaction():
+    connection = RecordingConnection()
+    cache = PreparedStatementCache(maxsize=2, threshold=1)
+    for sql in ("SELECT 1;", "SELECT 2;", "SELECT 1;", "SELECT 3;"):
+        run_prepared(cache, connection, sql)
+    assert not any(sql.startswith("DEALLOCATE") for sql in connection.log)
+    run_prepared(cache, connection, "SELECT 1;", idle=True)
+    assert connection.log[-2:] == ["DEALLOCATE ceritas_statement_1;", "EXECUTE ceritas_statement_0;"]
+
+def test_statements_are_prepared_again_after_a_reconnect():
+    connection = RecordingConnection()
+    cache = PreparedStatementCache(threshold=1)
+    run_prepared(cache, connection, "SELECT 1;")
+    connection.info.backend_pid = 2
+    run_prepared(cache, connection, "SELECT 1;")
+    assert [sql for sql in connection.log if sql.startswith("PREPARE")] == ["PREPARE ceritas_statement_0 AS SELECT 1;",
+                                                                             "PREPARE ceritas_statement_1 AS SELECT 1;"]
+
+# respond function of a session that lost ceritas_statement_0
+def lost_statement(sql, params):
+    if "EXECUTE ceritas_statement_0" in sql:
+        raise psycopg2.errors.InvalidSqlStatementName("prepared statement \"ceritas_statement_0\" does not exist")
+    return ["value"], [(1,)]
+
+def test_lost_statements_are_prepared_again_at_the_start_of_a_transaction():
+    connection = RecordingConnection()
+    cache = PreparedStatementCache(threshold=1)
+    run_prepared(cache, connection, "SELECT 1;", idle=True)
+    connection.respond = lost_statement
+    cursor = run_prepared(cache, connection, "SELECT 1;", idle=True)
+    assert cursor.fetchall() == [(1,)]
+    assert connection.log[2:] == ["EXECUTE ceritas_statement_0;", "ROLLBACK",
+                                  "PREPARE ceritas_statement_1 AS SELECT 1;", "EXECUTE ceritas_statement_1;"]
+
+def test_lost_statements_are_retried_inside_a_savepoint():
+    connection = RecordingConnection()
+    cache = PreparedStatementCache(threshold=1)
+    run_prepared(cache, connection, "SELECT 1;", idle=True)
+    run_prepared(cache, connection, "SELECT 2;", idle=True)
+    connection.respond = lost_statement
+    del connection.log[:]
+    cursor = run_prepared(cache, connection, "SELECT 1;")
+    assert cursor.fetchall() == [(1,)]
+    assert connection.log == ["SAVEPOINT ceritas_prepared; EXECUTE ceritas_statement_0;", "ROLLBACK TO SAVEPOINT ceritas_prepared;",
+                              "PREPARE ceritas_statement_2 AS SELECT 1;", "EXECUTE ceritas_statement_2;", "RELEASE SAVEPOINT ceritas_prepared;"]
+    # the rest of the transaction runs without savepoints, and the other statements of the session are prepared again
+    run_prepared(cache, connection, "SELECT 1;")
+    run_prepared(cache, connection, "SELECT 2;")
+    assert connection.log[5:] == ["EXECUTE ceritas_statement_2;", "PREPARE ceritas_statement_3 AS SELECT 2;", "EXECUTE ceritas_statement_3;"]
+
+def test_temporary_table_statements_are_not_prepared(recording_database):
+    recording_database.enable_prepared_statements(threshold=1)
+    cursor = recording_database.connection.cursor()
+    for i in range(3):
+        recording_database._execute(cursor, "SELECT id FROM core_products WHERE id IN (SELECT id FROM ceritas_ids_7);")
+    assert recording_database.connection.log == ["SELECT id FROM core_products WHERE id IN (SELECT id FROM ceritas_ids_7);"] * 3
+
+# DISCARD ALL drops the session's prepared statements without a reconnect
+def discard_all(database):
+    database.commit()
+    database.connection.autocommit = True
+    database.execute("DISCARD ALL;")
+    database.connection.autocommit = False
+
+def test_prepared_statements_survive_discard_all(database):
+    database.enable_prepared_statements(threshold=1)
+    expected = database.get_nvd_product_from_core_product(1)
+    discard_all(database)
+    assert database.get_nvd_product_from_core_product(1) == expected
+    discard_all(database)
+    with database.borrow():
+        assert database.get_count_from_table("core_products") > 0
+        assert database.get_nvd_product_from_core_product(1) == expected
+        assert database.get_nvd_product_from_core_product(1) == expected
+
+def test_statement_template():
+    assert _statement_template("SELECT id FROM ceritas_ids_12;") == "SELECT id FROM ceritas_ids_N;"
+    assert _statement_template("DEALLOCATE ceritas_statement_7;") == "DEALLOCATE ceritas_statement_N;"
+
+def test_nested_calls_count_against_every_method(recording_database):
+    instrumentation = recording_database.enable_instrumentation()
+    recording_database.get_vulnerable_products()
+    report = instrumentation.report()
+    assert report['methods']['get_vulnerable_products']['calls'] == 1
+    assert report['methods']['get_vulnerable_products']['round_trips'] == 2
+    assert report['methods']['get_product_info_by_id']['round_trips'] == 1
+    assert set(report['statements']) == {"SELECT core_product_id FROM nvd_products WHERE core_product_id IS NOT NULL;",
+                                         "SELECT id FROM core_products WHERE false;"}
+
+def test_temporary_table_statements_are_counted(recording_database, small_limits):
+    instrumentation = recording_database.enable_instrumentation()
+    list(recording_database._id_filters("core_products", "id", [1, 2, 3, 4]))
+    assert sum(stats.calls for stats in instrumentation.statements.values()) == 4
+
+def test_parse_condition(recording_database):
+    assert recording_database.parse_condition("name = Acme Corp") == ("name", "Acme Corp")
+    assert recording_database.list_to_sql(["id", "name"]) == "id, name"